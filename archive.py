@@ -1,184 +1,1386 @@
 #!venv/bin/python
 
 import os
-import sqlite3
-import logging
 import io
+import sys
+import signal
+import time
+import logging
 import hashlib
+import functools
+import collections
+import threading
+import itertools
 import concurrent.futures
+from datetime import datetime, timezone
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+import bundle
+import cache
+import metadata
+import reader
+import scheduler
+import chunker
 import crawler
+import metrics
 import util
 
 logger = logging.getLogger('archive')
 
+LATEST = 2**63-1 # the snapshot id meaning "the latest version"
+
 class Archive:
     db_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),'metadata.sqlite')
     chunk_size = 268435456 # 256 MB
+    incremental = True # trust the stat index to skip unchanged files
+    bundle_file_size = 65536 # files this size or smaller go in bundles
+    bundle_size = 16777216 # 16 MB
+    large_file_size = 67108864 # 64 MB, files bigger than this go in the large file lane
+    compact_segments = 100 # metadata segments between snapshots
 
     def __init__(self):
         self.settings = util.Settings()
-        self.encrypt = util.Encrypt(self.settings['encryption-token'])
+        target = self.settings.get('compression-target', None)
+        self.encrypt = util.Encrypt(self.settings['encryption-token'],
+                                    self.settings.get('compression-level', 22),
+                                    target*1048576 if target else None)
+        self.compression_extensions = self.settings.get('compression-extensions', {})
+        self.compression_paths = sorted(self.settings.get('compression-paths', {}).items(),
+                                        key=lambda p: len(p[0]), reverse=True)
+        if self.settings.get('chunking', 'fixed') == 'cdc':
+            self.chunker = functools.partial(chunker.FastCDC,
+                                             self.settings.get('chunk-min-size', 1048576),
+                                             self.settings.get('chunk-avg-size', 4194304),
+                                             self.settings.get('chunk-max-size', 16777216))
+        else:
+            self.chunker = functools.partial(chunker.Fixed, self.chunk_size)
+
+        concurrency = self.settings.get('s3-max-concurrency', 10)
+        self.transfer_config = TransferConfig(
+            multipart_threshold=self.settings.get('s3-multipart-threshold', 8388608),
+            multipart_chunksize=self.settings.get('s3-part-size', 8388608),
+            max_concurrency=concurrency,
+            max_bandwidth=self.settings.get('s3-max-bandwidth', None))
+
+        # chunks of the same file upload in parallel, while the next chunk is encoded
+        chunk_threads = self.settings.get('chunk-upload-threads', 4)
+        self.chunk_executor = concurrent.futures.ThreadPoolExecutor(max_workers=chunk_threads)
+        self.chunk_uploads = threading.BoundedSemaphore(chunk_threads)
+        self.chunk_downloads = self.settings.get('chunk-download-threads', 4)
+        self.download_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.chunk_downloads)
 
+        # one client is shared by every thread, so size its connection
+        # pool for all of them, instead of the default of 10. upload lane
+        # threads make one request at a time, while restore and verify
+        # threads, chunk uploads and downloads, and the bundler or
+        # metadata upload can each make a transfer of `concurrency` parts
+        lanes = (self.settings.get('upload-threads', 20) + self.settings.get('large-file-threads', 4)
+                 + self.settings.get('metadata-threads', 4))
+        connections = self.settings.get('s3-max-connections',
+            max(lanes,
+                self.settings.get('restore-threads', 20) * concurrency,
+                self.settings.get('verify-threads', 16) * concurrency)
+            + (chunk_threads + self.chunk_downloads + 1) * concurrency)
         self.s3 = boto3.client('s3', region_name='us-east',
                                endpoint_url=self.settings['s3-url'],
                                aws_access_key_id=self.settings['s3-access-key'],
-                               aws_secret_access_key=self.settings['s3-secret-key'])
+                               aws_secret_access_key=self.settings['s3-secret-key'],
+                               config=Config(
+                                   max_pool_connections=connections,
+                                   connect_timeout=self.settings.get('s3-connect-timeout', 10),
+                                   read_timeout=self.settings.get('s3-read-timeout', 60),
+                                   tcp_keepalive=True,
+                                   retries={
+                                       'mode': self.settings.get('s3-retry-mode', 'adaptive'),
+                                       'max_attempts': self.settings.get('s3-max-attempts', 10),
+                                   }))
                                
+        cache_size = self.settings.get('chunk-cache-size', 4294967296)
+        self.chunk_cache = None
+        if cache_size:
+            self.chunk_cache = cache.ChunkCache(
+                self.settings.get('chunk-cache-dir', os.path.join(os.path.dirname(self.db_filename), 'chunk_cache')),
+                cache_size)
+
+        self.snapshot_id = None
+        self.snapshot_lock = threading.Lock()
+        self.job = None # the path being uploaded by upload_many
+        self.directories = set()
+        self.directories_lock = threading.Lock()
+
+        # content stored during this run, so it is only uploaded once
+        self.stored = util.ContentCache()
+        self.hardlinks = util.ContentCache()
+
+        # upload lanes and rate limits
+        self.scheduler = scheduler.Scheduler(self.settings)
+        self.s3.meta.events.register('before-call.s3', self._request_limit)
+
+        self.metadata = self.open_metadata()
+        self.bundler = bundle.Bundler(self.s3, self.settings['s3-bucket'],
+                                      self.metadata, self.bundle_size,
+                                      self.transfer_config,
+                                      self.scheduler.limits['upload'])
+        if 'chunks' in self.metadata.created and self.metadata.query('SELECT count(*) FROM files')[0][0]:
+            logger.warning('chunk index does not exist. rebuilding it from the bucket listing')
+            self.rebuild_chunk_index()
+
+        # log the throughput of each stage now and then
+        self.metrics_file = self.settings.get('metrics-file', None)
+        metrics.stats.start(self.settings.get('metrics-interval', 60), self.metrics_file)
+
+        # settings are read again on a thread of their own, when asked by `reload`
+        self.reloading = threading.Event()
+        self.closed = False
+        self.reloader = threading.Thread(target=self._reloader, daemon=True)
+        self.reloader.start()
+
+    def _request_limit(self, **kwargs):
+        self.scheduler.limits['requests'].take(1)
+
+    def configure(self):
+        """
+        Read the settings again, and apply the rate limits from them.
+        If the settings cannot be read or applied, the old ones are kept.
+        """
+        settings = util.Settings()
+        try:
+            self.scheduler.configure(settings)
+        except Exception:
+            self.scheduler.configure(self.settings)
+            raise
+        self.settings = settings
+
+    def reload(self):
+        """Ask for the settings to be read again.  Safe to call from a signal handler."""
+        self.reloading.set()
+
+    def _reloader(self):
+        while True:
+            self.reloading.wait()
+            self.reloading.clear()
+            if self.closed:
+                return
+            try:
+                self.configure()
+                logger.info('settings reloaded')
+            except Exception:
+                logger.error('cannot reload the settings, keeping the old ones', exc_info=True)
+
+    def list_objects(self, prefix=''):
+        """List objects in the bucket, yielding (key, size)"""
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.settings['s3-bucket'], Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key'], obj['Size']
+
+    def list_metadata(self):
+        """Get the metadata segments and snapshots in the bucket, as {seq: key} dicts"""
+        segments = {}
+        snapshots = {}
+        for key, size in self.list_objects('metadata/'):
+            if not key.startswith('metadata/'):
+                continue
+            kind, seq = key[len('metadata/'):].rsplit('-', 1)
+            if kind == 'segment':
+                segments[int(seq)] = key
+            elif kind == 'snapshot':
+                snapshots[int(seq)] = key
+        return segments, snapshots
+
+    def download_db(self, key):
+        """Download a full copy of the metadata database"""
+        tmp = self.db_filename+'.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                self.download(key, f)
+            os.replace(tmp, self.db_filename)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def open_metadata(self):
+        """
+        Open the metadata database, bringing it up to date with the bucket.
+
+        Metadata is kept in S3 as a series of encrypted segments, each
+        holding the catalog changes from one run, plus a periodic
+        snapshot of the whole database.  Only the segments newer than
+        the local database are downloaded and replayed.
+
+        A segment this database uploaded itself, before it stopped and
+        could record it, is not replayed, since its changes are already
+        here.
+        """
+        segments, snapshots = self.list_metadata()
+        latest = max(snapshots) if snapshots else None
         if not os.path.exists(self.db_filename):
             try:
-                b = io.BytesIO()
-                self.s3.download_fileobj(Bucket=self.settings['s3-bucket'],
-                                         Key='metadata.sqlite',
-                                         Fileobj=b)
-                with open(db_filename, 'wb') as f:
-                    f.write(self.encrypt.decode(b.getvalue()))
+                if latest is not None:
+                    self.download_db(snapshots[latest])
+                else:
+                    # a single database object, from before segments
+                    self.download_db('metadata.sqlite')
             except ClientError:
                 logger.warning('metadata.sqlite does not exist. making a new one')
-        with sqlite3.connect(self.db_filename) as db:
-            db.execute('CREATE TABLE IF NOT EXISTS files (path, size, type, date_modified, link_path, sha256sum, chunk_checksums)')
-            db.execute('CREATE UNIQUE INDEX IF NOT EXISTS path_index on files (path)')
-        db.close()
+        m = metadata.Metadata(self.db_filename,
+                              self.settings.get('metadata-batch-size', 1000),
+                              self.settings.get('metadata-batch-time', 1.0))
+        last = m.get_state('last_segment', 0)
+        if latest is not None and last < latest and last+1 not in segments:
+            logger.warning('metadata.sqlite is older than the last snapshot. reloading it')
+            m.close()
+            self.download_db(snapshots[latest])
+            m = metadata.Metadata(self.db_filename,
+                                  self.settings.get('metadata-batch-size', 1000),
+                                  self.settings.get('metadata-batch-time', 1.0))
+            last = m.get_state('last_segment', 0)
+        # (seq, sync log end, checksum) of a segment this database was uploading
+        uploading = m.get_state('uploading_segment')
+        uploading = uploading.split() if uploading else None
+        for seq in sorted(s for s in segments if s > last):
+            with util.spool() as b:
+                self.download(segments[seq], b)
+                b.seek(0)
+                position = [('INSERT OR REPLACE INTO sync_state (key, value) values (?,?)', ('last_segment', seq))]
+                if uploading and int(uploading[0]) == seq:
+                    # either way, the upload is no longer in doubt
+                    position.append(('DELETE FROM sync_state WHERE key = ?', ('uploading_segment',)))
+                if uploading and int(uploading[0]) == seq and self.log_checksum(b) == uploading[2]:
+                    logger.info('metadata segment %d is from this database', seq)
+                    statements = [('DELETE FROM sync_log WHERE id <= ?', (int(uploading[1]),))]
+                else:
+                    logger.info('applying metadata segment %d', seq)
+                    statements = m.load_log(b)
+                # the whole segment and the new position apply atomically
+                m.write(itertools.chain(statements, position), log=False)
+                try:
+                    m.flush()
+                    if m.get_state('last_segment', 0) != seq:
+                        raise Exception('metadata segment %d was not applied' % seq)
+                except Exception:
+                    m.close()
+                    raise
+        return m
 
-    def close(self):
-        with open(self.db_filename, 'rb') as f:
-            data = f.read()
-        data = io.BytesIO(self.encrypt.encode(data))
-        self.s3.upload_fileobj(Fileobj=data,
-                               Bucket=self.settings['s3-bucket'],
-                               Key='metadata.sqlite')
-
-    def upload_one(self, filename):
-        """Upload a single file"""
-        if not os.path.isfile(filename):
-            logger.error('cannot backup %s: not a file or link', filename)
-        db = sqlite3.connect(self.db_filename)
+    @staticmethod
+    def log_checksum(f):
+        """Get the checksum of a sync log file, leaving it at the start"""
+        h = util.HashWriter()
+        f.seek(0)
+        for data in iter(lambda: f.read(util.SPOOL_SIZE), b''):
+            h.write(data)
+        f.seek(0)
+        return h.hexdigest()
+
+    def rebuild_chunk_index(self):
+        """Rebuild the chunk index from a listing of the bucket"""
+        refcounts = collections.Counter()
+        for sha256sum, chunk_checksums in self.metadata.iterate('SELECT sha256sum, chunk_checksums FROM files WHERE type = "file"'):
+            if chunk_checksums:
+                refcounts.update(chunk_checksums.split(','))
+            else:
+                refcounts[sha256sum] += 1
+        for bundle_key, in self.metadata.iterate('SELECT bundle FROM bundled'):
+            refcounts[bundle_key] += 1
+        self.metadata.write([('DELETE FROM chunks', ())])
+        batch = []
+        for key, size in self.list_objects():
+            if key == 'metadata.sqlite' or key.startswith('metadata/'):
+                continue
+            batch.append(('INSERT OR REPLACE INTO chunks (key, size, refcount) values (?,?,?)',
+                          (key, size, refcounts[key])))
+            if len(batch) >= 1000:
+                self.metadata.write(batch)
+                batch = []
+        self.metadata.write(batch)
+        self.metadata.flush()
+
+    def verify_listing(self):
+        """
+        Cross-check the catalog and chunk index against a bucket listing.
+
+        The bucket is listed in parallel, one worker per first hex digit
+        of the keys (bundles start with "b"), and each part is merged with
+        the same key range of the chunk index, so neither is held in
+        memory.  Then every object the catalog refers to is looked up in
+        the chunk index.
+
+        Yields:
+            tuple: (problem, key), where problem is one of:
+                   "missing" - in the index, not in the bucket
+                   "orphaned" - in the bucket, not in the index
+                   "size" - the sizes in the index and the bucket differ
+                   "unreferenced" - in the index, with no catalog entries
+                   "unindexed" - in the catalog, not in the index
+        """
+        def check(prefix):
+            problems = []
+            rows = self.metadata.iterate('SELECT key, size, refcount FROM chunks WHERE key >= ? AND key < ? ORDER BY key',
+                                         (prefix, chr(ord(prefix)+1)))
+            row = next(rows, None)
+            for key, size in self.list_objects(prefix):
+                while row and row[0] < key:
+                    problems.append(('missing', row[0]))
+                    row = next(rows, None)
+                if not row or row[0] != key:
+                    problems.append(('orphaned', key))
+                    continue
+                if row[1] != size:
+                    problems.append(('size', key))
+                if not row[2]:
+                    problems.append(('unreferenced', key))
+                row = next(rows, None)
+            while row:
+                problems.append(('missing', row[0]))
+                row = next(rows, None)
+            return problems
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.settings.get('verify-threads', 16)) as executor:
+            for problems in executor.map(check, '0123456789abcdef'):
+                yield from problems
+
+        def indexed(key):
+            return self.metadata.query('SELECT count(*) FROM chunks WHERE key = ?', (key,))[0][0]
+        for sha256sum, chunk_checksums in self.metadata.iterate('SELECT DISTINCT sha256sum, chunk_checksums FROM files WHERE type = "file"'):
+            if chunk_checksums:
+                keys = chunk_checksums.split(',')
+            else:
+                ret = self.metadata.query('SELECT bundle FROM bundled WHERE checksum = ?', (sha256sum,))
+                keys = [ret[0][0] if ret else sha256sum]
+            for key in keys:
+                if not indexed(key):
+                    yield 'unindexed', key
+
+    def verify_object(self, key):
+        """
+        Download, decode, and re-hash an object.
+
+        Chunks must hash to their key.  Bundles must hash to their key,
+        and each object in them to its checksum.
+
+        Returns:
+            list: (problem, key) tuples, where problem is "missing" or "corrupt"
+        """
         try:
-            cur = db.cursor()
-            cur.execute('SELECT count(*) FROM files WHERE path = ?', (filename,))
-            ret = cur.fetchall()
-            if ret[0][0] > 0:
-                logger.info('already uploaded: %s', filename)
-                return
-            type = 'link' if os.path.islink(filename) else 'file'
-            date_modified = util.get_date_modified(filename)
-            if type == 'link':
-                real_path = os.readlink(filename)
-                if not real_path.startswith('/'):
-                    real_path = os.path.join(os.path.dirname(filename), real_path)
-                with db:
-                    cur.execute('INSERT INTO files (path, size, type, date_modified, link_path, sha256sum, chunk_checksums) values (?,0,"link",?,?,"","")',
-                                (filename, date_modified, real_path))
-                logger.info('link: %s', filename)
-            else: # this is a real file
-                size = os.path.getsize(filename)
-                total_cksm = util.sha512sum(filename)
-                chunk_cksms = []
-                if size > self.chunk_size:
-                    # make chunks
-                    with open(filename,'rb') as f:
-                        chunk = f.read(self.chunk_size)
-                        while chunk:
-                            cksm = hashlib.sha512(chunk).hexdigest()
-                            try:
-                                # check if already exists, which can happen if we stopped
-                                # in the middle of a large file
-                                self.s3.head_object(Bucket=self.settings['s3-bucket'],
-                                                    Key=cksm)
-                            except ClientError:
-                                # need to upload
-                                data = io.BytesIO(self.encrypt.encode(chunk))
-                                self.s3.upload_fileobj(Fileobj=data,
-                                                       Bucket=self.settings['s3-bucket'],
-                                                       Key=cksm)
-                            chunk_cksms.append(cksm)
-                            chunk = f.read(self.chunk_size)
-                else:
-                    with open(filename,'rb') as f:
-                        data = f.read()
-                    data = io.BytesIO(self.encrypt.encode(data))
+            if key.startswith('bundles/'):
+                problems = []
+                with util.spool() as b:
+                    self.s3.download_fileobj(Bucket=self.settings['s3-bucket'],
+                                             Key=key,
+                                             Fileobj=b,
+                                             Config=self.transfer_config)
+                    b.seek(0)
+                    h = hashlib.sha512()
+                    for data in iter(lambda: b.read(util.SPOOL_SIZE), b''):
+                        h.update(data)
+                    if 'bundles/'+h.hexdigest() != key:
+                        return [('corrupt', key)]
+                    for checksum, offset, length in self.metadata.iterate('SELECT checksum, offset, length FROM bundled WHERE bundle = ?', (key,)):
+                        b.seek(offset)
+                        h = util.HashWriter()
+                        try:
+                            self.encrypt.decode_stream(io.BytesIO(b.read(length)), h)
+                        except Exception:
+                            pass
+                        if h.hexdigest() != checksum:
+                            problems.append(('corrupt', key+':'+checksum))
+                return problems
+            h = util.HashWriter()
+            self.download(key, h)
+        except ClientError:
+            return [('missing', key)]
+        except Exception:
+            logger.info('cannot decode %s', key, exc_info=True)
+            return [('corrupt', key)]
+        if h.hexdigest() != key:
+            return [('corrupt', key)]
+        return []
+
+    def verify_objects(self, bandwidth=None):
+        """
+        Download, decode, and re-hash every object in the chunk index.
+
+        Objects are checked several at a time, in key order.  The last
+        key checked (with every key before it also checked) is saved, so
+        a stopped verify continues where it stopped.  Objects are always
+        read from S3, not the chunk cache, since S3 is what is verified.
+
+        Args:
+            bandwidth (float): (optional) the most bytes/s to download
+
+        Yields:
+            tuple: (problem, key), from `verify_object`
+        """
+        bucket = util.TokenBucket(bandwidth)
+        threads = self.settings.get('verify-threads', 16)
+        position = self.metadata.get_state('verify_position') or ''
+        if position:
+            logger.info('continuing verify after %s', position)
+        def verify(key, size):
+            bucket.take(size)
+            return self.verify_object(key)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = collections.deque()
+            def finish():
+                key, fut = pending.popleft()
+                yield from fut.result()
+                self.metadata.set_state('verify_position', key)
+            for key, size in self.metadata.iterate('SELECT key, size FROM chunks WHERE key > ? ORDER BY key', (position,)):
+                while len(pending) >= threads*2 or (pending and pending[0][1].done()):
+                    yield from finish()
+                pending.append((key, executor.submit(verify, key, size)))
+            while pending:
+                yield from finish()
+        self.metadata.set_state('verify_position', None)
+
+    def close(self):
+        self.closed = True
+        self.reloading.set()
+        self.reloader.join()
+        self.bundler.flush()
+        self.scheduler.shutdown()
+        self.chunk_executor.shutdown()
+        self.download_executor.shutdown()
+        self.encrypt.stop_pool()
+        if self.chunk_cache:
+            logger.info('chunk cache: %r', dict(self.chunk_cache.stats))
+        self.save_metadata()
+        metrics.stats.stop(self.metrics_file)
+
+    def save_metadata(self):
+        """
+        Upload the catalog changes from this run as a new segment.
+
+        Every `compact_segments` segments, a snapshot of the whole
+        database is uploaded instead, and older segments are removed.
+        """
+        self.metadata.flush()
+        last = self.metadata.get_state('last_segment', 0)
+        snapshot = self.metadata.get_state('last_snapshot')
+        with util.spool() as log:
+            end = self.metadata.dump_log(log)
+            if end is not None:
+                last += 1
+                # if this stops before the sync log is cleared, the next
+                # open knows the segment is already in this database
+                self.metadata.set_state('uploading_segment', '%d %d %s' % (last, end, self.log_checksum(log)))
+                self.metadata.flush()
+                with util.spool() as data:
+                    self.encrypt.encode_stream(log, data)
+                    self.scheduler.limits['upload'].take(data.tell())
+                    data.seek(0)
                     self.s3.upload_fileobj(Fileobj=data,
                                            Bucket=self.settings['s3-bucket'],
-                                           Key=total_cksm)
-                with db:
-                    cur.execute('INSERT INTO files (path, size, type, date_modified, link_path, sha256sum, chunk_checksums) values (?,?,"file",?,"",?,?)',
-                                (filename, size, date_modified, total_cksm, ','.join(chunk_cksms)))
-                logger.info('uploaded: %s', filename)
+                                           Key='metadata/segment-%012d' % last,
+                                           Config=self.transfer_config)
+                self.metadata.write([
+                    ('DELETE FROM sync_log WHERE id <= ?', (end,)),
+                    ('INSERT OR REPLACE INTO sync_state (key, value) values (?,?)', ('last_segment', last)),
+                    ('DELETE FROM sync_state WHERE key = ?', ('uploading_segment',)),
+                ], log=False)
+        compact = snapshot is None or last-snapshot >= self.settings.get('metadata-compact-segments', self.compact_segments)
+        if compact:
+            self.metadata.set_state('last_snapshot', last)
+        self.metadata.close()
+        if compact:
+            with open(self.db_filename, 'rb') as f, util.spool() as data:
+                self.encrypt.encode_stream(f, data)
+                self.scheduler.limits['upload'].take(data.tell())
+                data.seek(0)
+                self.s3.upload_fileobj(Fileobj=data,
+                                       Bucket=self.settings['s3-bucket'],
+                                       Key='metadata/snapshot-%012d' % last,
+                                       Config=self.transfer_config)
+            segments, snapshots = self.list_metadata()
+            old = [segments[s] for s in segments if s <= last]
+            old.extend(snapshots[s] for s in snapshots if s < last)
+            for i in range(0, len(old), 1000):
+                self.s3.delete_objects(Bucket=self.settings['s3-bucket'],
+                                       Delete={'Objects': [{'Key': k} for k in old[i:i+1000]]})
+
+    def download(self, key, fileobj, start=0, end=None):
+        """
+        Download and decode an object, writing it to `fileobj`
+
+        Args:
+            key (str): the object key
+            fileobj (file): file object to write the decoded data to
+            start (int): (optional) the first byte of decoded data to write
+            end (int): (optional) where to stop writing decoded data
+        """
+        if end is not None:
+            # stream the object, so reading stops at the end of the range
+            with metrics.timer('s3_get_range'):
+                ret = self.s3.get_object(Bucket=self.settings['s3-bucket'], Key=key)
+                try:
+                    self.encrypt.decode_stream(ret['Body'], fileobj, start, end)
+                finally:
+                    ret['Body'].close()
+            return
+        with util.spool() as b:
+            begin = time.monotonic()
+            self.s3.download_fileobj(Bucket=self.settings['s3-bucket'],
+                                     Key=key,
+                                     Fileobj=b,
+                                     Config=self.transfer_config)
+            size = b.tell()
+            metrics.observe('s3_get', time.monotonic()-begin, size)
+            b.seek(0)
+            with metrics.timer('decode', size):
+                self.encrypt.decode_stream(b, fileobj, start)
+
+    def fetch(self, key, fileobj, start=0, end=None):
+        """
+        Get a decoded object, from the chunk cache if it is there, or S3.
+
+        Whole objects from S3 go in the chunk cache on the way, written
+        to the cache and `fileobj` in the same pass.  Files in bundles
+        are not cached, since they are small and take one ranged GET.
+
+        Args:
+            key (str): the checksum of the decoded object
+            fileobj (file): file object to write the decoded data to
+            start (int): (optional) the first byte of decoded data to write
+            end (int): (optional) where to stop writing decoded data
+        """
+        download = functools.partial(self.download, key)
+        if self.chunk_cache:
+            if self.chunk_cache.get(key, fileobj, start, end):
+                return
+            if end is None:
+                with self.chunk_cache.put(key) as f:
+                    download(util.TeeWriter(f, fileobj, start), 0, None)
+                return
+        download(fileobj, start, end)
+
+    def download_range(self, key, offset, length, fileobj, start=0, end=None):
+        """Download and decode an object stored inside a bundle"""
+        with metrics.timer('s3_get_range', length):
+            ret = self.s3.get_object(Bucket=self.settings['s3-bucket'],
+                                     Key=key,
+                                     Range='bytes=%d-%d' % (offset, offset+length-1))
+            self.encrypt.decode_stream(ret['Body'], fileobj, start, end)
+
+    def upload_chunk(self, key, fileobj, stored=None):
+        """
+        Upload an encoded chunk and add it to the chunk index
+
+        Args:
+            key (str): the chunk checksum
+            fileobj (file): the encoded chunk
+            stored (Future): (optional) resolved once the chunk is uploaded
+        """
+        try:
+            size = fileobj.seek(0, os.SEEK_END)
+            fileobj.seek(0)
+            self.scheduler.limits['upload'].take(size)
+            with metrics.timer('s3_put', size):
+                self.s3.upload_fileobj(Fileobj=fileobj,
+                                       Bucket=self.settings['s3-bucket'],
+                                       Key=key,
+                                       Config=self.transfer_config)
+            self.metadata.write([('INSERT OR IGNORE INTO chunks (key, size, refcount) values (?,?,0)',
+                                  (key, size))])
+        except Exception as e:
+            if stored:
+                stored.set_exception(e)
+            raise
+        else:
+            if stored:
+                stored.set_result(key)
         finally:
-            db.close()
+            fileobj.close()
+            self.chunk_uploads.release()
 
-    def upload_many(self, path):
-        """Upload a path (file or directory)"""
-        if not os.path.isdir(path):
-            self.upload_one(path)
+    def compression_level(self, filename):
+        """
+        Get the compression level for a file.
+
+        The longest matching prefix in `compression-paths` wins, then
+        the extension in `compression-extensions`.  Otherwise returns
+        None, for the default level.
+        """
+        for prefix, level in self.compression_paths:
+            if filename == prefix or filename.startswith(prefix.rstrip('/')+'/'):
+                return level
+        ext = os.path.splitext(filename)[1].lower()
+        return self.compression_extensions.get(ext, None)
+
+    def upload_one(self, entry):
+        """
+        Upload a single file
+
+        Args:
+            entry (crawler.Entry or str): the file, from the crawler or a path
+        """
+        entry = self.upload_metadata(entry)
+        if entry:
+            self.upload_content(entry)
+
+    def schedule_one(self, entry):
+        """
+        Upload a single file, from the metadata lane of the scheduler.
+
+        Files with content to upload are handed off to the small or
+        large file lane.
+        """
+        entry = self.upload_metadata(entry)
+        if entry:
+            lane = 'large' if entry.size > self.large_file_size else 'small'
+            self.scheduler.submit(lane, self.upload_content, entry)
+
+    def upload_metadata(self, entry):
+        """
+        Upload what only needs the metadata of a file: links, and files
+        that have not changed.
+
+        Args:
+            entry (crawler.Entry or str): the file, from the crawler or a path
+
+        Returns:
+            crawler.Entry: the file, if its content needs uploading, or None
+        """
+        if not isinstance(entry, crawler.Entry):
+            try:
+                entry = crawler.Entry.from_path(entry)
+            except OSError:
+                logger.error('cannot backup %s: cannot stat', entry)
+                self.journal_done(entry)
+                return
+        filename = entry.path
+        if not (entry.is_file() or entry.is_link()):
+            logger.error('cannot backup %s: not a file or link', filename)
+            self.journal_done(filename)
+            return
+        snapshot = self.start_snapshot()
+        file_stat = (entry.size, entry.mtime, entry.inode)
+        ret = self.metadata.query('SELECT size, mtime, inode, snapshot FROM stat_index WHERE path = ?', (filename,))
+        # a file already done in this snapshot is from a stopped run, even with --full
+        if ret and ret[0][:3] == file_stat and (self.incremental or ret[0][3] == snapshot):
+            # mark it as seen, so it is not taken as deleted
+            self.metadata.write([('UPDATE stat_index SET snapshot = ? WHERE path = ?', (snapshot, filename))], log=False)
+            self.journal_done(filename)
+            metrics.add('files_unchanged')
+            logger.info('unchanged: %s', filename)
+            return
+        if entry.is_link():
+            date_modified = util.format_date(entry.mtime / 1e9)
+            parent = self.add_directory(os.path.dirname(filename))
+            real_path = entry.link
+            if not real_path.startswith('/'):
+                real_path = os.path.join(os.path.dirname(filename), real_path)
+            self.metadata.write([
+                ('INSERT OR REPLACE INTO files (path, size, type, date_modified, link_path, sha256sum, chunk_checksums, chunk_sizes, snapshot, parent) values (?,0,"link",?,?,"","","",?,?)',
+                 (filename, date_modified, real_path, snapshot, parent)),
+                ('INSERT OR REPLACE INTO stat_index (path, size, mtime, inode, snapshot) values (?,?,?,?,?)',
+                 (filename,)+file_stat+(snapshot,)),
+            ])
+            self.journal_done(filename)
+            logger.info('link: %s', filename)
         else:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
-                for r in executor.map(self.upload_one, crawler.generate_files(path)):
+            return entry
+
+    def upload_content(self, entry):
+        """
+        Upload the content of a file, and add it to the catalog.
+
+        Args:
+            entry (crawler.Entry): the file
+        """
+        filename = entry.path
+        snapshot = self.start_snapshot()
+        file_stat = (entry.size, entry.mtime, entry.inode)
+        date_modified = util.format_date(entry.mtime / 1e9)
+        parent = self.add_directory(os.path.dirname(filename))
+        content = None
+        hardlink = None
+        if entry.nlink > 1:
+            # read each hardlinked file once per run. the other
+            # links get the content of the first one seen
+            hardlink, new = self.hardlinks.claim((entry.dev, entry.inode)+file_stat[:2])
+            if not new:
+                try:
+                    content = hardlink.result()
+                except Exception:
                     pass
+                hardlink = None
+        bundle_data = None
+        bundled = None
+        if content is None:
+            try:
+                total_cksm, size, chunk_cksms, chunk_sizes, bundle_data, stored = self.encode_file(entry)
+            except OSError as e:
+                # removed or made unreadable since it was crawled
+                if hardlink:
+                    hardlink.set_exception(e)
+                logger.error('cannot backup %s: %s', filename, e)
+                self.journal_done(filename)
+                return
+            except Exception as e:
+                if hardlink:
+                    hardlink.set_exception(e)
+                raise
+            link_path = ''
+        else:
+            link_path, total_cksm, size, chunk_cksms, chunk_sizes, stored, bundled = content
+        statements = [
+            ('INSERT OR REPLACE INTO files (path, size, type, date_modified, link_path, sha256sum, chunk_checksums, chunk_sizes, snapshot, parent) values (?,?,"file",?,?,?,?,?,?,?)',
+             (filename, size, date_modified, link_path, total_cksm, ','.join(chunk_cksms), ','.join(map(str, chunk_sizes)), snapshot, parent)),
+            ('INSERT OR REPLACE INTO stat_index (path, size, mtime, inode, snapshot) values (?,?,?,?,?)',
+             (filename,)+file_stat+(snapshot,)),
+        ]
+        statements.extend(('UPDATE chunks SET refcount = refcount + 1 WHERE key = ?', (k,))
+                          for k in (chunk_cksms or [total_cksm]))
+        if bundle_data is not None:
+            # the catalog is updated once the bundle is uploaded
+            try:
+                bundled = self.bundler.add(total_cksm, bundle_data, statements)
+            except Exception as e:
+                if hardlink:
+                    hardlink.set_exception(e)
+                raise
+            if self.job:
+                bundled.add_done_callback(functools.partial(self._journal_file, filename))
+        if hardlink:
+            # only what the other links need, not the encoded data
+            hardlink.set_result((filename, total_cksm, size, chunk_cksms, chunk_sizes, stored, bundled))
+        if bundle_data is not None:
+            logger.info('bundled: %s', filename)
+        elif bundled is not None:
+            # a link to a bundled file is recorded once the bundle is
+            bundled.add_done_callback(functools.partial(self._write_link, filename, statements))
+            logger.info('bundled: %s', filename)
+        else:
+            # wait for the chunks this run is uploading, by any worker
+            with metrics.timer('wait_upload'):
+                for s in stored:
+                    s.result()
+            self.metadata.write(statements)
+            self.journal_done(filename)
+            logger.info('uploaded: %s', filename)
 
-    def restore_one(self, filename, output):
-        """Restore a single file"""
-        db = sqlite3.connect(self.db_filename)
+    def _write_link(self, filename, statements, fut):
+        if fut.exception() is None:
+            self.metadata.write(statements)
+            self.journal_done(filename)
+        else:
+            logger.error('bundle upload failed, dropping %s', filename)
+
+    def journal_done(self, filename):
+        """Remove a file from the upload journal, once it is in the catalog"""
+        if self.job:
+            self.metadata.write([('DELETE FROM upload_files WHERE path = ?', (filename,)),
+                                 ('DELETE FROM upload_chunks WHERE path = ?', (filename,))], log=False)
+
+    def journal_chunks(self, entry):
+        """
+        Get the chunks of a file uploaded by a stopped run.
+
+        Returns:
+            list: (checksum, size) of the first chunks of the file
+        """
+        ret = self.metadata.query('SELECT size, mtime, inode FROM upload_files WHERE path = ?', (entry.path,))
+        if not ret:
+            return []
+        if ret[0] != (entry.size, entry.mtime, entry.inode):
+            # changed since it was crawled
+            self.metadata.write([('DELETE FROM upload_chunks WHERE path = ?', (entry.path,))], log=False)
+            return []
+        chunks = []
+        for n, cksm, size in self.metadata.iterate('SELECT n, checksum, size FROM upload_chunks WHERE path = ? ORDER BY n', (entry.path,)):
+            if n != len(chunks):
+                break
+            chunks.append((cksm, size))
+        return chunks
+
+    def encode_file(self, entry):
+        """
+        Read, encode, and start uploading a file.
+
+        Each chunk is read and hashed first, and only encoded if it is
+        not in the chunk index or already claimed by another worker in
+        this run.  New chunks are uploaded in the background.  Small
+        files are returned encoded, for the bundler.
+
+        During `upload_many`, each uploaded chunk is recorded in the
+        journal.  The chunks a stopped run uploaded are only read again
+        for the whole-file checksum, not encoded.
+
+        Args:
+            entry (crawler.Entry): the file
+
+        Returns:
+            tuple: (checksum, size, chunk checksums, chunk sizes,
+                    encoded data to bundle or None, Futures for the chunks being uploaded)
+        """
+        # read each byte once, feeding the whole-file checksum
+        # and the chunk checksum from the same buffer
+        total = hashlib.sha512()
+        size = 0
+        chunk_cksms = []
+        chunk_sizes = []
+        bundle_data = None
+        waits = []
+        c = self.chunker()
+        level = self.compression_level(entry.path)
+        journaled = self.journal_chunks(entry) if self.job and entry.size > self.bundle_file_size else []
+        with open(entry.path,'rb') as f:
+            f = util.LimitedReader(f, self.scheduler.limits['read'])
+            for cksm, length in journaled:
+                remaining = length
+                while remaining:
+                    data = f.read(min(remaining, util.SPOOL_SIZE))
+                    if not data:
+                        raise Exception('%s is shorter than when it was crawled' % entry.path)
+                    with metrics.timer('hash', len(data)):
+                        total.update(data)
+                    remaining -= len(data)
+                chunk_cksms.append(cksm)
+                chunk_sizes.append(length)
+                size += length
+            if journaled and size == entry.size:
+                # all chunks uploaded before
+                chunks = []
+            else:
+                chunks = util.read_chunks(f, c, total)
+            # the file can change after it was crawled, so whether it is
+            # bundled is only known once it is read. hold back a small
+            # first chunk until the next one, or the end, is seen
+            held = None
+            try:
+                for cksm, length, plain in chunks:
+                    if held:
+                        with held:
+                            waits.extend(self.store_chunk(entry, 0, chunk_cksms[0], chunk_sizes[0], held, level))
+                        held = None
+                    if not chunk_cksms and length <= self.bundle_file_size:
+                        held = plain
+                    else:
+                        with plain:
+                            waits.extend(self.store_chunk(entry, len(chunk_cksms), cksm, length, plain, level))
+                    chunk_cksms.append(cksm)
+                    chunk_sizes.append(length)
+                    size += length
+                if held:
+                    # the whole file is one small chunk
+                    ret = self.metadata.query('SELECT count(*) FROM bundled WHERE checksum = ?', (chunk_cksms[0],))
+                    ret2 = self.metadata.query('SELECT count(*) FROM chunks WHERE key = ?', (chunk_cksms[0],))
+                    if ret[0][0] == 0 and ret2[0][0] == 0:
+                        out = io.BytesIO()
+                        self.encrypt.encode_stream(held, out, level)
+                        bundle_data = out.getvalue()
+            finally:
+                if held:
+                    held.close()
+        if len(chunk_cksms) < 2:
+            # a single chunk is stored under the whole-file checksum
+            chunk_cksms = []
+            chunk_sizes = []
+        return total.hexdigest(), size, chunk_cksms, chunk_sizes, bundle_data, waits
+
+    def store_chunk(self, entry, n, cksm, length, plain, level):
+        """
+        Encode and start uploading a chunk, unless it is already stored.
+
+        The chunk can already be in the chunk index, from another file,
+        an older version, or a stopped run, or be claimed by another
+        worker in this run.
+
+        Args:
+            entry (crawler.Entry): the file
+            n (int): the chunk number in the file
+            cksm (str): the chunk checksum
+            length (int): the chunk size
+            plain (file): the chunk
+            level (int): the compression level, or None for the default
+
+        Returns:
+            list: the Future for the chunk being uploaded, if not in the chunk index
+        """
+        ret = self.metadata.query('SELECT count(*) FROM chunks WHERE key = ?', (cksm,))
+        indexed = ret[0][0] != 0
+        waits = []
+        if not indexed:
+            stored, new = self.stored.claim(cksm)
+            waits.append(stored)
+            if new:
+                data = util.spool()
+                try:
+                    self.encrypt.encode_stream(plain, data, level)
+                except Exception as e:
+                    data.close()
+                    stored.set_exception(e)
+                    raise
+                # wait for a free upload slot, so only a few
+                # encoded chunks are waiting at a time
+                self.chunk_uploads.acquire()
+                self.chunk_executor.submit(self.upload_chunk, cksm, data, stored)
+        if self.job:
+            record = ('INSERT OR REPLACE INTO upload_chunks (path, n, checksum, size) values (?,?,?,?)',
+                      (entry.path, n, cksm, length))
+            if indexed:
+                self.metadata.write([record], log=False)
+            else:
+                stored.add_done_callback(functools.partial(self._journal_chunk, record))
+        return waits
+
+    def _journal_file(self, filename, fut):
+        if fut.exception() is None:
+            self.journal_done(filename)
+
+    def _journal_chunk(self, record, fut):
+        if fut.exception() is None:
+            self.metadata.write([record], log=False)
+
+    def upload_many(self, path):
+        """
+        Upload a path (file or directory)
+
+        Uploads are a pipeline: the crawler feeds the scheduler's
+        metadata lane, which skips unchanged files and hands the rest
+        to the small or large file lane, where they are read and hashed.
+        Frames are compressed and encrypted in a process pool, and
+        chunks are uploaded by the chunk executor.  Each stage only runs
+        a little ahead of the next.
+
+        Progress is kept in a journal in the metadata database: the
+        directories not yet crawled, the files crawled but not yet in
+        the catalog, and the chunks of those files already uploaded.
+        If a run stops, the next upload of the same path continues it,
+        in the same snapshot, without crawling or encoding again.
+        """
+        self.encrypt.start_pool(self.settings.get('encode-processes', os.cpu_count()))
+        ret = self.metadata.query('SELECT snapshot FROM upload_jobs WHERE path = ?', (path,))
+        if ret:
+            with self.snapshot_lock:
+                if self.snapshot_id is None:
+                    self.snapshot_id = ret[0][0]
+            logger.warning('continuing the stopped upload of %s', path)
+        else:
+            statements = [('INSERT INTO upload_jobs (path, snapshot) values (?,?)', (path, self.start_snapshot()))]
+            if os.path.isdir(path):
+                statements.append(('INSERT OR REPLACE INTO upload_dirs (path, job) values (?,?)', (path, path)))
+            else:
+                try:
+                    st = os.lstat(path)
+                    file_stat = (st.st_size, st.st_mtime_ns, st.st_ino)
+                except OSError:
+                    file_stat = (None, None, None)
+                statements.append(('INSERT OR REPLACE INTO upload_files (path, job, size, mtime, inode) values (?,?,?,?,?)',
+                                   (path, path)+file_stat))
+            self.metadata.write(statements, log=False)
+            self.metadata.flush()
+        self.job = path
         try:
-            cur = db.cursor()
-            cur.execute('SELECT * FROM files WHERE path = ?', (filename,))
-            ret = cur.fetchall()
-            if not ret:
-                raise Exception('file not found: %s' % filename)
-            for path, size, type, date_modified, link_path, sha256sum, chunk_checksums, in ret:
-                pass # loop variables exist after the loop
+            try:
+                for entry in self.journal_entries(path):
+                    self.scheduler.submit('metadata', self.schedule_one, entry)
+                self.scheduler.join()
+            except BaseException:
+                # drop the queued work, the journal has it for the next run
+                self.scheduler.cancel()
+                try:
+                    self.scheduler.join()
+                except Exception:
+                    logger.error('upload error while stopping', exc_info=True)
+                raise
+            if os.path.isdir(path):
+                self.mark_deleted(path)
+            self.bundler.flush()
+        finally:
+            self.job = None
+        self.metadata.write([
+            ('DELETE FROM upload_chunks WHERE path NOT IN (SELECT path FROM upload_files WHERE job != ?)', (path,)),
+            ('DELETE FROM upload_files WHERE job = ?', (path,)),
+            ('DELETE FROM upload_dirs WHERE job = ?', (path,)),
+            ('DELETE FROM upload_jobs WHERE path = ?', (path,)),
+        ], log=False)
+        self.metadata.flush()
+
+    def journal_entries(self, job):
+        """
+        Get the files of an upload job that are not in the catalog yet.
 
+        The files a stopped run crawled come first, then the directories
+        it did not get to are crawled.  Each directory crawled is
+        recorded in the journal, with its files and subdirectories.
+
+        Yields:
+            crawler.Entry or str: a file, or a path that cannot be read
+        """
+        for filename, in self.metadata.iterate('SELECT path FROM upload_files WHERE job = ?', (job,)):
             try:
-                if not os.path.isdir(output):
-                    os.makedirs(os.path.basename(output))
+                yield crawler.Entry.from_path(filename)
             except OSError:
-                pass
-            if type == 'link':
-                os.symlink(output, link_path)
-            else:
-                if chunk_checksums:
-                    with open(output, 'wb') as f:
-                        for cksm in chunk_checksums.split(','):
-                            try:
-                                b = io.BytesIO()
-                                self.s3.download_fileobj(Bucket=self.settings['s3-bucket'],
-                                                         Key=cksm,
-                                                         Fileobj=b)
-                                f.write(self.encrypt.decode(b.getvalue()))
-                            except ClientError:
-                                raise Exception('chunk for file not found: %s' % filename)
-                else:
+                yield filename
+        dirs = [d for d, in self.metadata.query('SELECT path FROM upload_dirs WHERE job = ?', (job,))]
+        if not dirs:
+            return
+        def scanned(d, subdirs, entries):
+            statements = [('DELETE FROM upload_dirs WHERE path = ?', (d,))]
+            statements.extend(('INSERT OR REPLACE INTO upload_dirs (path, job) values (?,?)', (s, job)) for s in subdirs)
+            statements.extend(('INSERT OR REPLACE INTO upload_files (path, job, size, mtime, inode) values (?,?,?,?,?)',
+                               (e.path, job, e.size, e.mtime, e.inode)) for e in entries)
+            self.metadata.write(statements, log=False)
+            metrics.add('crawl_dirs')
+            metrics.add('crawl_files', len(entries))
+        yield from crawler.crawl(dirs, self.settings.get('crawl-threads', 20), scanned=scanned)
+
+    def mark_deleted(self, path):
+        """
+        Record the files under a directory that were not seen in this run
+        as deleted in this run's snapshot.
+        """
+        snapshot = self.start_snapshot()
+        self.metadata.flush()
+        ret = self.metadata.iterate('SELECT path FROM stat_index WHERE path >= ? AND path < ? AND (snapshot IS NULL OR snapshot < ?)',
+                                    metadata.subtree(path)+(snapshot,))
+        for filename, in ret:
+            if os.path.lexists(filename):
+                # not crawled, but still there
+                continue
+            self.metadata.write([
+                ('INSERT OR REPLACE INTO files (path, size, type, date_modified, link_path, sha256sum, chunk_checksums, chunk_sizes, snapshot, parent) values (?,0,"deleted","","","","","",?,?)',
+                 (filename, snapshot, metadata.dir_id(os.path.dirname(filename)))),
+                ('DELETE FROM stat_index WHERE path = ?', (filename,)),
+            ])
+            logger.info('deleted: %s', filename)
+
+    def add_directory(self, path):
+        """
+        Add a directory and its parents to the directory tree, once per run.
+
+        Returns:
+            int: the directory id
+        """
+        statements = []
+        with self.directories_lock:
+            for row in metadata.ancestors(path):
+                if row[2] in self.directories:
+                    break
+                self.directories.add(row[2])
+                statements.append(('INSERT OR IGNORE INTO directories (id, parent, path) values (?,?,?)', row))
+        if statements:
+            self.metadata.write(statements)
+        return metadata.dir_id(path)
+
+    def start_snapshot(self):
+        """Get the snapshot id of this run, making the snapshot on first use"""
+        with self.snapshot_lock:
+            if self.snapshot_id is None:
+                ret = self.metadata.query('SELECT max(id) FROM snapshots')
+                self.snapshot_id = (ret[0][0] or 0) + 1
+                self.metadata.write([('INSERT INTO snapshots (id, date) values (?,?)',
+                                      (self.snapshot_id, util.format_date(time.time())))])
+            return self.snapshot_id
+
+    def list_snapshots(self):
+        """Get all snapshots, as (id, date) tuples"""
+        return self.metadata.query('SELECT id, date FROM snapshots ORDER BY id')
+
+    def find_snapshot(self, as_of):
+        """
+        Find a snapshot.
+
+        Args:
+            as_of (str): a snapshot id, or an ISO 8601 date (UTC if no timezone is given)
+
+        Returns:
+            int: the snapshot id, which is the last snapshot at or before a date
+        """
+        if as_of.isdigit():
+            return int(as_of)
+        date = datetime.fromisoformat(as_of)
+        if not date.tzinfo:
+            date = date.replace(tzinfo=timezone.utc)
+        ret = self.metadata.query('SELECT max(id) FROM snapshots WHERE date <= ?',
+                                  (util.format_date(date.timestamp()),))
+        if ret[0][0] is None:
+            raise Exception('no snapshot before %s' % as_of)
+        return ret[0][0]
+
+    def diff_snapshots(self, old, new):
+        """
+        Compare two snapshots.
+
+        Only the versions written after `old`, up to `new`, are read.
+
+        Args:
+            old (int): the older snapshot id
+            new (int): the newer snapshot id
+
+        Yields:
+            tuple: (change, path), where change is "added", "modified", or "deleted"
+        """
+        # sqlite takes the other columns from the row with the max()
+        for path, type, s in self.metadata.iterate('SELECT path, type, max(snapshot) FROM files WHERE snapshot > ? AND snapshot <= ? GROUP BY path ORDER BY path',
+                                                   (old, new)):
+            ret = self.metadata.query('SELECT type FROM files WHERE path = ? AND snapshot <= ? ORDER BY snapshot DESC LIMIT 1',
+                                      (path, old))
+            existed = ret and ret[0][0] != 'deleted'
+            if type != 'deleted':
+                yield ('modified' if existed else 'added'), path
+            elif existed:
+                yield 'deleted', path
+
+    def download_chunk(self, key, fd, offset):
+        """Download a chunk, writing it to `fd` at `offset`"""
+        self.fetch(key, util.OffsetWriter(fd, offset))
+
+    def download_many(self, jobs):
+        """
+        Run downloads on the download executor, with only a window of
+        them in flight at a time.
+
+        Args:
+            jobs (iterable): (function, args...) tuples
+        """
+        pending = set()
+        try:
+            for func, *args in jobs:
+                if len(pending) >= self.chunk_downloads:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for d in done:
+                        d.result()
+                pending.add(self.download_executor.submit(func, *args))
+            for d in concurrent.futures.as_completed(pending):
+                d.result()
+        finally:
+            concurrent.futures.wait(pending)
+
+    def get_file(self, filename, snapshot=LATEST):
+        """
+        Get the catalog entry for a file, as of a snapshot.
+
+        Returns:
+            tuple: (size, type, date_modified, link_path, sha256sum, chunk_checksums, chunk_sizes)
+        """
+        ret = self.metadata.query('SELECT size, type, date_modified, link_path, sha256sum, chunk_checksums, chunk_sizes FROM files WHERE path = ? AND snapshot <= ? ORDER BY snapshot DESC LIMIT 1',
+                                  (filename, snapshot))
+        if not ret or ret[0][1] == 'deleted':
+            raise Exception('file not found: %s' % filename)
+        return ret[0]
+
+    def chunk_map(self, filename, snapshot=LATEST):
+        """
+        Map a file to the objects holding it.
+
+        Returns:
+            tuple: (chunk sizes, fetch), where fetch(index, fileobj, start, end)
+                   writes bytes `start` to `end` of chunk `index` to fileobj
+        """
+        size, type, date_modified, link_path, sha256sum, chunk_checksums, chunk_sizes = self.get_file(filename, snapshot)
+        if type != 'file':
+            raise Exception('not a file: %s' % filename)
+        if chunk_checksums and not chunk_sizes:
+            raise Exception('no chunk sizes for %s. it can only be restored in full' % filename)
+        elif chunk_checksums:
+            keys = chunk_checksums.split(',')
+            sizes = [int(s) for s in chunk_sizes.split(',')]
+        else:
+            bundled = self.metadata.query('SELECT bundle, offset, length FROM bundled WHERE checksum = ?', (sha256sum,))
+            if bundled:
+                def fetch(index, fileobj, start=0, end=None):
+                    self.download_range(*bundled[0], fileobj, start, end)
+                return [size], fetch
+            keys = [sha256sum]
+            sizes = [size]
+        def fetch(index, fileobj, start=0, end=None):
+            self.fetch(keys[index], fileobj, start, end)
+        return sizes, fetch
+
+    def open(self, filename, snapshot=LATEST, cache_size=4):
+        """
+        Open an archived file for reading, without restoring it.
+
+        Args:
+            filename (str): the file
+            snapshot (int): the snapshot id
+            cache_size (int): the number of decoded chunks to keep
+
+        Returns:
+            io.BufferedReader: a read-only, seekable file, which fetches chunks as they are read
+        """
+        sizes, fetch = self.chunk_map(filename, snapshot)
+        return io.BufferedReader(reader.ChunkReader(fetch, sizes, cache_size))
+
+    def restore_range(self, filename, output, offset, length, snapshot=LATEST):
+        """
+        Restore part of a file.
+
+        Only the chunks holding the range are downloaded, several at a
+        time, and each is only read up to the end of the range.
+
+        Args:
+            filename (str): the file
+            output (str): where to write the range
+            offset (int): the start of the range
+            length (int): the length of the range
+            snapshot (int): the snapshot id
+        """
+        sizes, fetch = self.chunk_map(filename, snapshot)
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'wb') as f:
+            fd = f.fileno()
+            def jobs():
+                pos = 0
+                for index, size in enumerate(sizes):
+                    start = max(offset-pos, 0)
+                    end = min(offset+length-pos, size)
+                    if start < end:
+                        yield fetch, index, util.OffsetWriter(fd, pos+start-offset), start, end
+                    pos += size
+            try:
+                self.download_many(jobs())
+            except ClientError:
+                raise Exception('chunk for file not found: %s' % filename)
+
+    def restore_one(self, filename, output, snapshot=LATEST):
+        """Restore a single file, as of a snapshot"""
+        size, type, date_modified, link_path, sha256sum, chunk_checksums, chunk_sizes = self.get_file(filename, snapshot)
+        if not chunk_checksums:
+            bundled = self.metadata.query('SELECT bundle, offset, length FROM bundled WHERE checksum = ?', (sha256sum,))
+
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        if type == 'link':
+            if os.path.lexists(output):
+                os.remove(output)
+            os.symlink(link_path, output)
+        elif chunk_checksums and chunk_sizes:
+            # download and decode chunks in parallel, each written at its
+            # offset, with only a window of chunks in flight at a time
+            with open(output, 'wb') as f:
+                f.truncate(size)
+                fd = f.fileno()
+                offsets = itertools.accumulate(map(int, chunk_sizes.split(',')), initial=0)
+                try:
+                    self.download_many((self.download_chunk, cksm, fd, offset)
+                                       for cksm, offset in zip(chunk_checksums.split(','), offsets))
+                except ClientError:
+                    raise Exception('chunk for file not found: %s' % filename)
+        elif chunk_checksums:
+            # older entries do not have chunk sizes, so go in order
+            with open(output, 'wb') as f:
+                for cksm in chunk_checksums.split(','):
                     try:
-                        b = io.BytesIO()
-                        self.s3.download_fileobj(Bucket=self.settings['s3-bucket'],
-                                                 Key=sha256sum,
-                                                 Fileobj=b)
-                        with open(output, 'wb') as f:
-                            f.write(self.encrypt.decode(b.getvalue()))
+                        self.fetch(cksm, f)
                     except ClientError:
                         raise Exception('chunk for file not found: %s' % filename)
-            util.set_date_modified(output, date_modified)
-        finally:
-            db.close()
+        else:
+            try:
+                with open(output, 'wb') as f:
+                    if bundled:
+                        self.download_range(*bundled[0], f)
+                    else:
+                        self.fetch(sha256sum, f)
+            except ClientError:
+                raise Exception('chunk for file not found: %s' % filename)
+        util.set_date_modified(output, date_modified)
 
-    def restore_many(self, path, output):
-        """Restore a path (file or directory)"""
-        db = sqlite3.connect(self.db_filename)
-        try:
-            cur = db.cursor()
-            cur.execute('SELECT * FROM files WHERE path like ?', (filename+'%',))
-            ret = cur.fetchall()
-            if not ret:
-                raise Exception('file/directory not found: %s' % filename)
-            for f in ret:
-                common = os.path.commonprefix([f,path])
-                extra = f[len(common)-1:]
-                self.restore_one(f, output+extra)
-        finally:
-            db.close()
+    def iterate_tree(self, path, snapshot=LATEST):
+        """
+        Get the latest version of a path and of everything under it, as
+        of a snapshot.
+
+        Rows are read one at a time, from a range scan of the path index.
+
+        Args:
+            path (str): a file or directory
+            snapshot (int): the snapshot id
+
+        Yields:
+            tuple: (path, size, type, link_path, sha256sum), in path order
+        """
+        path = path.rstrip('/')
+        # sqlite takes the other columns from the row with the max()
+        sql = 'SELECT path, size, type, link_path, sha256sum, max(snapshot) FROM files WHERE {} AND snapshot <= ? GROUP BY path'
+        for rows in (self.metadata.iterate(sql.format('path = ?'), (path, snapshot)),
+                     self.metadata.iterate(sql.format('path >= ? AND path < ?'), metadata.subtree(path)+(snapshot,))):
+            for row in rows:
+                if row[2] != 'deleted':
+                    yield row[:-1]
+
+    def list_dir(self, path, snapshot=LATEST):
+        """
+        List a directory, like `ls`, as of a snapshot.
+
+        Args:
+            path (str): the directory
+            snapshot (int): the snapshot id
+
+        Yields:
+            tuple: (path, type, size, date_modified), directories first
+        """
+        parent = metadata.dir_id(os.path.normpath(path))
+        for p, in self.metadata.iterate('SELECT path FROM directories WHERE parent = ? ORDER BY path', (parent,)):
+            yield p, 'directory', None, None
+        for p, t, s, d, _ in self.metadata.iterate('SELECT path, type, size, date_modified, max(snapshot) FROM files WHERE parent = ? AND snapshot <= ? GROUP BY path',
+                                                   (parent, snapshot)):
+            if t != 'deleted':
+                yield p, t, s, d
+
+    def du(self, path, snapshot=LATEST):
+        """
+        Total the files under a path, like `du`, as of a snapshot.
+
+        Returns:
+            tuple: (number of files, total size)
+        """
+        files = size = 0
+        for p, s, t, l, c in self.iterate_tree(path, snapshot):
+            if t == 'file':
+                files += 1
+                size += s
+        return files, size
+
+    def restore_many(self, path, output, snapshot=LATEST):
+        """
+        Restore a path (file or directory), as of a snapshot
+
+        Files are read from the catalog and restored as they go, with only
+        a window of restores in flight.
+
+        Hardlinks are restored as hardlinks when the first link is
+        restored too, and as separate files otherwise.
+        """
+        path = path.rstrip('/')
+        threads = self.settings.get('restore-threads', 20)
+        lo, hi = metadata.subtree(path)
+        hardlinks = []
+        found = False
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = set()
+            for f, s, t, l, c in self.iterate_tree(path, snapshot):
+                found = True
+                if t == 'file' and (l == path or lo <= l < hi):
+                    hardlinks.append((f, l, c))
+                    continue
+                if len(pending) >= threads*2:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for d in done:
+                        d.result()
+                pending.add(executor.submit(self.restore_one, f, output+f[len(path):], snapshot))
+            for d in concurrent.futures.as_completed(pending):
+                d.result()
+        if not found:
+            raise Exception('file/directory not found: %s' % path)
+        for f, l, c in hardlinks:
+            out = output+f[len(path):]
+            ret = self.metadata.query('SELECT type, sha256sum FROM files WHERE path = ? AND snapshot <= ? ORDER BY snapshot DESC LIMIT 1',
+                                      (l, snapshot))
+            if not ret or ret[0] != ('file', c):
+                # the first link was not restored with the same content
+                self.restore_one(f, out, snapshot)
+                continue
+            os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+            if os.path.lexists(out):
+                os.remove(out)
+            os.link(output+l[len(path):], out)
 
 if __name__ == '__main__':
     import argparse
@@ -186,17 +1388,59 @@ if __name__ == '__main__':
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--upload', action='store_true', default=False, help='Upload mode')
     group.add_argument('--restore', default=None, help='Restore dir')
-    parser.add_argument('paths', default=[], action='append', help='paths to upload/restore')
+    group.add_argument('--snapshots', action='store_true', default=False, help='List snapshots')
+    group.add_argument('--diff', nargs=2, default=None, metavar=('OLD', 'NEW'), help='List changes between two snapshots')
+    group.add_argument('--ls', action='store_true', default=False, help='List directories in the catalog')
+    group.add_argument('--du', action='store_true', default=False, help='Total the files under paths in the catalog')
+    group.add_argument('--verify', nargs='?', const='listing', default=None, choices=['listing', 'deep'],
+                       help='Check the archive against a bucket listing, or (deep) download and re-hash every object')
+    parser.add_argument('--full', action='store_true', default=False, help='Re-hash every file instead of trusting the stat index')
+    parser.add_argument('--as-of', default=None, help='Restore or list as of a snapshot id or date')
+    parser.add_argument('--range', nargs=2, type=int, default=None, metavar=('OFFSET', 'LENGTH'), help='Restore only a byte range of each file')
+    parser.add_argument('paths', nargs='*', default=[], help='paths to upload/restore')
     args = parser.parse_args()
     ar = Archive()
+    ar.incremental = not args.full
+    # change the rate limits of a running archiver with `kill -HUP`
+    signal.signal(signal.SIGHUP, lambda signum, frame: ar.reload())
+    problems = 0
     try:
         if args.upload:
             for p in args.paths:
                 ar.upload_many(p)
+        elif args.verify:
+            if args.verify == 'listing':
+                results = ar.verify_listing()
+            else:
+                results = ar.verify_objects(ar.settings.get('verify-bandwidth', None))
+            for problem, key in results:
+                print(problem, key)
+                problems += 1
+        elif args.snapshots:
+            for snapshot, date in ar.list_snapshots():
+                print(snapshot, date)
+        elif args.diff:
+            old, new = (ar.find_snapshot(s) for s in args.diff)
+            for change, path in ar.diff_snapshots(old, new):
+                print(change, path)
+        elif args.ls or args.du:
+            snapshot = ar.find_snapshot(args.as_of) if args.as_of else LATEST
+            for p in args.paths:
+                if args.ls:
+                    for path, type, size, date in ar.list_dir(p, snapshot):
+                        print('%-9s %14s %-26s %s' % (type, '' if size is None else size, date or '', path))
+                else:
+                    files, size = ar.du(p, snapshot)
+                    print(size, files, p)
         else:
+            snapshot = ar.find_snapshot(args.as_of) if args.as_of else LATEST
             for p in args.paths:
                 output = os.path.join(args.restore, os.path.basename(p))
-                ar.restore_many(p, output)
+                if args.range:
+                    ar.restore_range(p, output, *args.range, snapshot)
+                else:
+                    ar.restore_many(p, output, snapshot)
     finally:
         ar.close()
-    
\ No newline at end of file
+    if problems:
+        sys.exit(1)
@@ -0,0 +1,297 @@
+#!venv/bin/python
+"""
+Benchmark uploads and restores of a synthetic tree.
+
+By default the bucket is a local directory, so the numbers show the
+archiver itself, not the network.  Give `--s3-url` (and keys) to run
+against a real S3 server, such as a local MinIO.
+"""
+
+import os
+import io
+import json
+import time
+import shutil
+import random
+import tempfile
+import types
+import logging
+
+from botocore.exceptions import ClientError
+
+import archive
+import metrics
+import util
+
+logger = logging.getLogger('benchmark')
+
+
+class LocalS3:
+    """
+    A stand-in for the S3 client, keeping objects as files in a directory.
+
+    Only has the calls the archiver makes.  Handlers registered for
+    events are called before each request, like "before-call" events.
+
+    Args:
+        path (str): the directory to keep buckets in
+    """
+    def __init__(self, path):
+        self.path = path
+        self.handlers = []
+        self.meta = types.SimpleNamespace(events=self)
+
+    def register(self, event, handler):
+        self.handlers.append(handler)
+
+    def _request(self):
+        for handler in self.handlers:
+            handler()
+
+    def _filename(self, Bucket, Key):
+        return os.path.join(self.path, Bucket, Key)
+
+    def _open(self, Bucket, Key, operation):
+        self._request()
+        try:
+            return open(self._filename(Bucket, Key), 'rb')
+        except FileNotFoundError:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': Key}}, operation)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        self._request()
+        filename = self._filename(Bucket, Key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename+'.tmp', 'wb') as f:
+            shutil.copyfileobj(Fileobj, f)
+        os.replace(filename+'.tmp', filename)
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        with self._open(Bucket, Key, 'GetObject') as f:
+            shutil.copyfileobj(f, Fileobj)
+
+    def get_object(self, Bucket, Key, Range=None):
+        with self._open(Bucket, Key, 'GetObject') as f:
+            if Range:
+                start, end = map(int, Range.split('=')[1].split('-'))
+                f.seek(start)
+                data = f.read(end-start+1)
+            else:
+                data = f.read()
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    def delete_objects(self, Bucket, Delete):
+        self._request()
+        for obj in Delete['Objects']:
+            os.remove(self._filename(Bucket, obj['Key']))
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix=''):
+        self._request()
+        root = os.path.join(self.path, Bucket)
+        contents = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                key = os.path.relpath(filename, root)
+                if key.startswith(Prefix) and not key.endswith('.tmp'):
+                    contents.append({'Key': key, 'Size': os.path.getsize(filename)})
+        contents.sort(key=lambda c: c['Key'])
+        yield {'Contents': contents}
+
+
+def make_tree(path, small=1000, small_size=16384, large=4, large_size=268435456, dirs=10, compressible=0.5):
+    """
+    Make a tree of files to back up.
+
+    Args:
+        path (str): the directory to make
+        small (int): the number of small files
+        small_size (int): the average size of a small file
+        large (int): the number of large files
+        large_size (int): the size of each large file
+        dirs (int): the number of directories to spread the files over
+        compressible (float): the fraction of each file that is zeros
+
+    Returns:
+        int: the total size of the files
+    """
+    rand = random.Random(42)
+    total = 0
+    def write(filename, size):
+        zeros = int(size*compressible)
+        with open(filename, 'wb') as f:
+            while size > zeros:
+                n = min(size-zeros, 16777216)
+                f.write(rand.randbytes(n))
+                size -= n
+            while size:
+                n = min(size, 16777216)
+                f.write(bytes(n))
+                size -= n
+    for d in range(dirs):
+        os.makedirs(os.path.join(path, 'dir%d' % d), exist_ok=True)
+    for i in range(small):
+        size = int(rand.expovariate(1/small_size)) if small_size else 0
+        write(os.path.join(path, 'dir%d' % (i % dirs), 'small%d' % i), size)
+        total += size
+    for i in range(large):
+        write(os.path.join(path, 'dir%d' % (i % dirs), 'large%d' % i), large_size)
+        total += large_size
+    return total
+
+def stage_report(elapsed):
+    """
+    Get the throughput of each stage, from the collected metrics.
+
+    Args:
+        elapsed (float): the wall time of the run, in seconds
+
+    Returns:
+        dict: {stage: {ops, ops/s, MB/s, avg seconds}}
+    """
+    ret = {}
+    with metrics.stats.lock:
+        histograms = dict(metrics.stats.histograms)
+        counters = dict(metrics.stats.counters)
+    for name, h in sorted(histograms.items()):
+        ret[name] = {
+            'ops': h.count,
+            'ops/s': h.count/elapsed,
+            'MB/s': h.bytes/elapsed/1048576,
+            'avg seconds': h.sum/h.count if h.count else 0,
+        }
+    for name, n in sorted(counters.items()):
+        ret[name] = {'ops': n, 'ops/s': n/elapsed}
+    return ret
+
+def run(args):
+    """
+    Build a tree, then time an upload and a restore of it.
+
+    Returns:
+        dict: {phase: {seconds, MB/s, stages}}
+    """
+    tmpdir = tempfile.mkdtemp(dir=args.dir)
+    curdir = os.getcwd()
+    try:
+        os.chdir(tmpdir)
+        src = os.path.join(tmpdir, 'src')
+        total = make_tree(src, args.small, args.small_size, args.large, args.large_size,
+                          args.dirs, args.compressible)
+        logger.info('made %d files, %d bytes', args.small+args.large, total)
+
+        util.Settings.filename = os.path.join(tmpdir, 'settings.json')
+        settings = {
+            's3-access-key': args.s3_access_key or 'local',
+            's3-secret-key': args.s3_secret_key or 'local',
+            's3-url': args.s3_url or 'local',
+            's3-bucket': args.s3_bucket,
+            'encryption-token': util.Encrypt.get_key(),
+            'chunk-cache-size': 0,
+            'metrics-interval': args.interval,
+        }
+        if args.settings:
+            with open(args.settings) as f:
+                settings.update(json.load(f))
+        with open(util.Settings.filename, 'w') as f:
+            json.dump(settings, f)
+
+        archive.Archive.db_filename = os.path.join(tmpdir, 'metadata.sqlite')
+        client = archive.boto3.client
+        if not args.s3_url:
+            s3 = LocalS3(os.path.join(tmpdir, 's3'))
+            archive.boto3.client = lambda *a, **kw: s3
+        try:
+            ar = archive.Archive()
+        finally:
+            archive.boto3.client = client
+
+        results = {}
+        try:
+            for phase in ('upload', 'restore'):
+                metrics.stats.reset()
+                start = time.monotonic()
+                if phase == 'upload':
+                    ar.upload_many(src)
+                else:
+                    ar.restore_many(src, os.path.join(tmpdir, 'dest'))
+                elapsed = time.monotonic()-start
+                results[phase] = {
+                    'seconds': elapsed,
+                    'MB/s': total/elapsed/1048576,
+                    'stages': stage_report(elapsed),
+                }
+        finally:
+            ar.close()
+        return results
+    finally:
+        os.chdir(curdir)
+        if not args.keep:
+            shutil.rmtree(tmpdir)
+
+def print_results(results):
+    for phase, r in results.items():
+        print('%s: %.2f seconds, %.1f MB/s' % (phase, r['seconds'], r['MB/s']))
+        for name, s in r['stages'].items():
+            line = '    %-20s %8d ops %10.1f ops/s' % (name, s['ops'], s['ops/s'])
+            if 'MB/s' in s:
+                line += ' %10.1f MB/s %8.4fs avg' % (s['MB/s'], s['avg seconds'])
+            print(line)
+
+def compare(results, baseline, tolerance):
+    """
+    Compare the throughput of each phase with an earlier run.
+
+    Returns:
+        list: a message for each phase more than `tolerance` slower
+    """
+    slower = []
+    for phase, r in results.items():
+        if phase not in baseline:
+            continue
+        old = baseline[phase]['MB/s']
+        if r['MB/s'] < old*(1-tolerance):
+            slower.append('%s: %.1f MB/s, was %.1f MB/s' % (phase, r['MB/s'], old))
+    return slower
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description='benchmark the s3 archiver')
+    parser.add_argument('--small', type=int, default=1000, help='Number of small files')
+    parser.add_argument('--small-size', type=int, default=16384, help='Average size of a small file')
+    parser.add_argument('--large', type=int, default=4, help='Number of large files')
+    parser.add_argument('--large-size', type=int, default=268435456, help='Size of a large file')
+    parser.add_argument('--dirs', type=int, default=10, help='Number of directories')
+    parser.add_argument('--compressible', type=float, default=0.5, help='Fraction of each file that compresses')
+    parser.add_argument('--settings', default=None, help='A json file of archiver settings to use')
+    parser.add_argument('--dir', default=None, help='Where to make the test tree')
+    parser.add_argument('--keep', action='store_true', default=False, help='Keep the test tree')
+    parser.add_argument('--interval', type=float, default=10, help='Seconds between metric log lines')
+    parser.add_argument('--s3-url', default=None, help='Use a real S3 server instead of a local directory')
+    parser.add_argument('--s3-access-key', default=None)
+    parser.add_argument('--s3-secret-key', default=None)
+    parser.add_argument('--s3-bucket', default='benchmark')
+    parser.add_argument('--json', default=None, help='Write the results to a json file')
+    parser.add_argument('--baseline', default=None, help='A json file of earlier results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='How much slower than the baseline is a regression')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    logging.getLogger('archive').setLevel(logging.WARNING)
+
+    results = run(args)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        for s in slower:
+            print('regression:', s)
+        if slower:
+            sys.exit(1)
@@ -0,0 +1,122 @@
+"""
+Pack small objects into bundles.
+"""
+
+import io
+import hashlib
+import threading
+import logging
+
+import metrics
+import util
+
+logger = logging.getLogger('bundle')
+
+
+class Bundler:
+    """
+    Pack small encoded objects into larger bundle objects.
+
+    Objects are appended to an in-memory bundle.  Once the bundle reaches
+    `size` it is uploaded, then the offset and length of each object in
+    the bundle are written to the `bundled` table, together with any
+    catalog statements that were waiting on the bundle, in one atomic write.
+    Nothing refers to a bundle until it is safely in S3.
+
+    Objects bundled earlier in the run are not added again.  Their
+    statements are written once the bundle holding them is written.
+
+    Args:
+        s3 (boto3.client): the S3 client
+        bucket (str): the S3 bucket
+        metadata (Metadata): the metadata database
+        size (int): the target bundle size
+        transfer_config (TransferConfig): (optional) S3 transfer settings
+        limit (TokenBucket): (optional) the upload limit, in bytes/s
+    """
+    def __init__(self, s3, bucket, metadata, size, transfer_config=None, limit=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.metadata = metadata
+        self.size = size
+        self.transfer_config = transfer_config
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.stored = util.ContentCache()
+        self._reset()
+
+    def _reset(self):
+        self.buf = io.BytesIO()
+        self.objects = {}
+        self.statements = []
+
+    def _swap(self):
+        ret = (self.buf, self.objects, self.statements)
+        self._reset()
+        return ret
+
+    def add(self, checksum, data, statements):
+        """
+        Add an object to the bundle.
+
+        Args:
+            checksum (str): the checksum of the object contents
+            data (bytes): the encoded object
+            statements (list): (sql, params) to run once the bundle is uploaded
+
+        Returns:
+            Future: resolved once the object and its statements are written
+        """
+        with self.lock:
+            fut, new = self.stored.claim(checksum)
+            if new:
+                self.objects[checksum] = (self.buf.tell(), len(data), fut)
+                self.buf.write(data)
+            if new or checksum in self.objects:
+                self.statements.extend(statements)
+            else:
+                # in an earlier bundle, which may still be uploading
+                fut.add_done_callback(lambda f: self._write(f, statements))
+                return fut
+            if self.buf.tell() < self.size:
+                return fut
+            ret = self._swap()
+        self._upload(*ret)
+        return fut
+
+    def _write(self, fut, statements):
+        if fut.exception() is None:
+            self.metadata.write(statements)
+        else:
+            logger.error('bundle upload failed, dropping %d statements', len(statements))
+
+    def flush(self):
+        """Upload the current bundle, even if not full"""
+        with self.lock:
+            ret = self._swap()
+        if ret[1]:
+            self._upload(*ret)
+
+    def _upload(self, buf, objects, statements):
+        key = 'bundles/' + hashlib.sha512(buf.getbuffer()).hexdigest()
+        buf.seek(0)
+        try:
+            if self.limit:
+                self.limit.take(len(buf.getbuffer()))
+            with metrics.timer('s3_put', len(buf.getbuffer())):
+                self.s3.upload_fileobj(Fileobj=buf,
+                                       Bucket=self.bucket,
+                                       Key=key,
+                                       Config=self.transfer_config)
+            writes = [('INSERT OR REPLACE INTO bundled (checksum, bundle, offset, length) values (?,?,?,?)',
+                       (c, key, o, l)) for c, (o, l, f) in objects.items()]
+            writes.append(('INSERT OR REPLACE INTO chunks (key, size, refcount) values (?,?,?)',
+                           (key, len(buf.getbuffer()), len(objects))))
+            self.metadata.write(writes + statements)
+        except Exception as e:
+            for o, l, f in objects.values():
+                f.set_exception(e)
+            raise
+        for o, l, f in objects.values():
+            f.set_result(key)
+        logger.info('uploaded bundle %s with %d objects', key, len(objects))
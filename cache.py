@@ -0,0 +1,192 @@
+"""
+A local cache of decoded chunks.
+"""
+
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+import contextlib
+import collections
+import logging
+
+import metrics
+
+logger = logging.getLogger('cache')
+
+BLOCK_SIZE = 4194304 # 4 MB
+
+
+class ChunkCache:
+    """
+    An on-disk, size-bounded LRU cache of decoded chunks, by checksum.
+
+    Each chunk is a file under `path`, written under a temporary name
+    and renamed into place, so readers never see part of a chunk.  The
+    size and last use of each chunk are kept in a small sqlite database
+    in WAL mode, so several threads and processes can share one cache.
+    The total size is kept in the database too, updated with each
+    chunk added or removed, so adding a chunk does not have to add up
+    the whole cache.  When the cache grows past `max_size`, the least
+    recently used chunks are removed.
+
+    The hit, miss, put, and eviction counts are metrics gauges.
+
+    Args:
+        path (str): the cache directory
+        max_size (int): the maximum size of the cache, in bytes
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        os.makedirs(path, exist_ok=True)
+        db = self._db()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS entries (key PRIMARY KEY, size, used)')
+        db.execute('CREATE INDEX IF NOT EXISTS used_index on entries (used)')
+        db.execute('CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY, size)')
+        # caches from before the total was kept
+        db.execute('INSERT OR IGNORE INTO totals (id, size) SELECT 0, coalesce(sum(size), 0) FROM entries')
+        for name in ('hits', 'misses', 'puts', 'evictions'):
+            metrics.gauge('chunk_cache_'+name, lambda name=name: self.stats[name])
+        metrics.gauge('chunk_cache_bytes', self.size)
+
+    def _db(self):
+        """Get the connection for this thread"""
+        try:
+            return self.local.db
+        except AttributeError:
+            self.local.db = sqlite3.connect(os.path.join(self.path, 'cache.sqlite'),
+                                            timeout=60, isolation_level=None)
+            self.local.db.execute('PRAGMA synchronous=NORMAL')
+            return self.local.db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def size(self):
+        """Get the total size of the cached chunks"""
+        return self._db().execute('SELECT size FROM totals WHERE id = 0').fetchone()[0]
+
+    def _filename(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def _count(self, **kwargs):
+        with self.lock:
+            self.stats.update(kwargs)
+
+    def copy(self, key, fileobj, start=0, end=None):
+        """
+        Copy a cached chunk, or part of it, to a file object, without
+        counting it in the stats.
+
+        Args:
+            key (str): the chunk checksum
+            fileobj (file): file object to write the chunk to
+            start (int): (optional) the first byte to write
+            end (int): (optional) where to stop writing
+
+        Returns:
+            int: the number of bytes copied, or None if the chunk is not cached
+        """
+        try:
+            f = open(self._filename(key), 'rb')
+        except FileNotFoundError:
+            return None
+        size = 0
+        with f:
+            f.seek(start)
+            while end is None or start+size < end:
+                data = f.read(BLOCK_SIZE if end is None else min(BLOCK_SIZE, end-start-size))
+                if not data:
+                    break
+                fileobj.write(data)
+                size += len(data)
+        self._db().execute('UPDATE entries SET used = ? WHERE key = ?', (time.time(), key))
+        return size
+
+    def get(self, key, fileobj, start=0, end=None):
+        """
+        Copy a cached chunk, or part of it, to a file object.
+
+        Args:
+            key (str): the chunk checksum
+            fileobj (file): file object to write the chunk to
+            start (int): (optional) the first byte to write
+            end (int): (optional) where to stop writing
+
+        Returns:
+            bool: True if the chunk was in the cache
+        """
+        size = self.copy(key, fileobj, start, end)
+        if size is None:
+            self._count(misses=1)
+            return False
+        self._count(hits=1, hit_bytes=size)
+        return True
+
+    @contextlib.contextmanager
+    def put(self, key):
+        """
+        Add a chunk to the cache.
+
+        A context manager giving a file to write the decoded chunk to.
+        The chunk is added once the block exits without an error.
+
+        Args:
+            key (str): the chunk checksum
+        """
+        dirname = os.path.dirname(self._filename(key))
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield f
+                size = f.tell()
+            os.replace(tmp, self._filename(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        with self._transaction() as db:
+            old = db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+            db.execute('INSERT OR REPLACE INTO entries (key, size, used) values (?,?,?)',
+                       (key, size, time.time()))
+            db.execute('UPDATE totals SET size = size + ? WHERE id = 0', (size - (old[0] if old else 0),))
+            total = db.execute('SELECT size FROM totals WHERE id = 0').fetchone()[0]
+        self._count(puts=1, put_bytes=size)
+        if total > self.max_size:
+            self._evict(key)
+
+    def _evict(self, keep):
+        """Remove the least recently used chunks, other than `keep`, until under the size limit"""
+        while True:
+            with self._transaction() as db:
+                total = db.execute('SELECT size FROM totals WHERE id = 0').fetchone()[0]
+                if total <= self.max_size:
+                    break
+                rows = db.execute('SELECT key, size FROM entries WHERE key != ? ORDER BY used LIMIT 100', (keep,)).fetchall()
+                if not rows:
+                    break
+                for key, size in rows:
+                    try:
+                        os.remove(self._filename(key))
+                    except FileNotFoundError:
+                        pass # removed by another process
+                    db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                    db.execute('UPDATE totals SET size = size - ? WHERE id = 0', (size,))
+                    self._count(evictions=1)
+                    total -= size
+                    if total <= self.max_size:
+                        break
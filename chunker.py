@@ -0,0 +1,175 @@
+"""
+Split files into chunks.
+
+Chunkers are fed a file a block at a time and report where the
+current chunk ends, so files never need to be held in memory.
+A chunker keeps state for a single file, so make a new one per file.
+"""
+
+import hashlib
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger('chunker')
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+WINDOW = 64 # bytes in the rolling hash
+
+# gear table for the rolling hash, fixed so chunk boundaries (and
+# therefore checksums) are stable across runs and machines
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big') for i in range(256)]
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64) if numpy else None
+
+
+def gear_hashes(data):
+    """
+    Get the gear hash at every byte of `data`, with numpy.
+
+    The hash at byte i is sum(GEAR[data[i-k]] << k) for k < 64, which
+    is built up by doubling the window, in 6 vector steps, instead of
+    one python step per byte.
+
+    Returns:
+        numpy.ndarray: the hash of the bytes from the start of `data`
+                       (at most 64) up to each byte
+    """
+    h = GEAR_ARRAY.take(numpy.frombuffer(data, dtype=numpy.uint8))
+    tmp = numpy.empty_like(h)
+    n = 1
+    while n < min(WINDOW, len(h)):
+        t = tmp[:len(h)-n]
+        numpy.left_shift(h[:-n], numpy.uint64(n), out=t)
+        h[n:] += t
+        n *= 2
+    return h
+
+
+class Fixed:
+    """
+    Fixed-size chunks.
+
+    Args:
+        size (int): the size of each chunk
+    """
+    def __init__(self, size):
+        self.size = size
+        self.min_size = size
+        self.pos = 0
+
+    def boundary(self, data):
+        """
+        Find the end of the current chunk.
+
+        Args:
+            data (bytes): the next block of the file
+
+        Returns:
+            int: the number of bytes of `data` that finish the current chunk,
+                 or None if the chunk continues past `data`
+        """
+        if self.pos + len(data) < self.size:
+            self.pos += len(data)
+            return None
+        n = self.size - self.pos
+        self.pos = 0
+        return n
+
+
+class FastCDC:
+    """
+    Content-defined chunks, using the FastCDC gear hash.
+
+    Boundaries depend only on the nearby content, so an insert or
+    delete only changes the chunks around it, and identical runs of
+    data in different files or versions produce identical chunks.
+
+    No boundary is looked for in the first `min_size` bytes of a chunk.
+    Until `avg_size` a stricter mask is used, and a looser one after,
+    which keeps chunk sizes close to the average (normalized chunking).
+
+    With numpy, the hash is computed `scan_block` bytes at a time with
+    vector operations, and finds the same boundaries as the python loop.
+
+    Args:
+        min_size (int): the minimum chunk size
+        avg_size (int): the average chunk size
+        max_size (int): the maximum chunk size
+    """
+    scan_block = 65536 # bytes hashed at a time with numpy, small enough to stay in cache
+
+    def __init__(self, min_size, avg_size, max_size):
+        if not 0 < min_size <= avg_size <= max_size:
+            raise Exception('chunk sizes must satisfy 0 < min <= avg <= max')
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        bits = max(avg_size.bit_length()-1, 2)
+        # use the high bits, which depend on the last 64 bytes
+        self.mask_s = ((1 << (bits+1))-1) << (63-bits)
+        self.mask_l = ((1 << (bits-1))-1) << (65-bits)
+        self.pos = 0
+        self.h = 0
+        self.tail = b'' # the last bytes hashed, with numpy
+
+    def _scan(self, data, start, end, mask):
+        if numpy is not None:
+            return self._scan_vector(data, start, end, mask)
+        h = self.h
+        gear = GEAR
+        for i, b in enumerate(data[start:end], start):
+            h = ((h << 1) + gear[b]) & MASK64
+            if not h & mask:
+                return i+1
+        self.h = h
+        return None
+
+    def _scan_vector(self, data, start, end, mask):
+        # the masks are the top bits, so a match is a hash below them
+        limit = numpy.uint64(~mask & MASK64)
+        for i in range(start, end, self.scan_block):
+            block = self.tail + data[i:min(i+self.scan_block, end)]
+            hits = numpy.flatnonzero(gear_hashes(block)[len(self.tail):] <= limit)
+            if hits.size:
+                return i+int(hits[0])+1
+            self.tail = block[-(WINDOW-1):]
+        return None
+
+    def _cut(self, n):
+        self.pos = 0
+        self.h = 0
+        self.tail = b''
+        return n
+
+    def boundary(self, data):
+        """
+        Find the end of the current chunk.
+
+        Args:
+            data (bytes): the next block of the file
+
+        Returns:
+            int: the number of bytes of `data` that finish the current chunk,
+                 or None if the chunk continues past `data`
+        """
+        pos = self.pos
+        n = len(data)
+        i = min(max(self.min_size-pos, 0), n)
+        if pos+i < self.avg_size:
+            end = min(self.avg_size-pos, n)
+            cut = self._scan(data, i, end, self.mask_s)
+            if cut:
+                return self._cut(cut)
+            i = end
+        end = min(self.max_size-pos, n)
+        if i < end:
+            cut = self._scan(data, i, end, self.mask_l)
+            if cut:
+                return self._cut(cut)
+        if pos+n >= self.max_size:
+            return self._cut(self.max_size-pos)
+        self.pos += n
+        return None
@@ -11,8 +11,12 @@ import grp
 import logging
 import json
 import hashlib
+import collections
+import queue
+from stat import S_ISLNK, S_ISREG
 from multiprocessing.pool import ThreadPool
 from threading import Thread
+import threading
 
 
 logger = logging.getLogger('crawler')
@@ -76,43 +80,187 @@ def stat(path):
     logging.info('completed %s',path)
     return ret
 
-def listdir(path):
-    dirs = []
-    files = []
-    try:
-        ld = os.listdir(path)
-    except Exception:
-        logger.warning("error reading dir %s", path, exc_info=True)
-        return [],[]
-    for f in ld:
-        p = os.path.join(path,f)
+class Entry:
+    """
+    A file found by the crawler.
+
+    Holds only the metadata the uploader needs, taken from a single
+    `lstat` (plus a `readlink` for symlinks), in slots so millions of
+    them stay small.
+
+    Args:
+        path (str): the path
+        st (os.stat_result): the lstat result for the path
+        link (str): (optional) the symlink target
+    """
+    __slots__ = ('path', 'size', 'mtime', 'mode', 'inode', 'dev', 'nlink', 'link')
+
+    def __init__(self, path, st, link=None):
+        self.path = path
+        self.size = st.st_size
+        self.mtime = st.st_mtime_ns
+        self.mode = st.st_mode
+        self.inode = st.st_ino
+        self.dev = st.st_dev
+        self.nlink = st.st_nlink
+        self.link = link
+
+    @classmethod
+    def from_path(cls, path, st=None):
+        """Make an Entry for a path, reading the metadata if `st` is not given"""
+        if st is None:
+            st = os.lstat(path)
+        link = os.readlink(path) if S_ISLNK(st.st_mode) else None
+        return cls(path, st, link)
+
+    def is_file(self):
+        return S_ISREG(self.mode)
+
+    def is_link(self):
+        return S_ISLNK(self.mode)
+
+    def __repr__(self):
+        return 'Entry(%r)' % self.path
+
+class WorkQueue:
+    """
+    A work-stealing queue of directories.
+
+    Each worker pushes and pops directories at the end of its own deque,
+    which walks the tree depth first and keeps the queue short.  A worker
+    with nothing left steals from the other end of another worker's deque,
+    which hands out the shallow directories with the most work under them.
+
+    Args:
+        workers (int): the number of workers
+    """
+    def __init__(self, workers):
+        self.deques = [collections.deque() for _ in range(workers)]
+        self.cond = threading.Condition()
+        self.pending = 0 # directories queued or being scanned
+        self.stopped = False
+
+    def put(self, worker, path):
+        with self.cond:
+            self.deques[worker].append(path)
+            self.pending += 1
+            self.cond.notify()
+
+    def get(self, worker):
+        """Get the next directory for a worker, or None when the crawl is done"""
+        with self.cond:
+            while not self.stopped:
+                if self.deques[worker]:
+                    return self.deques[worker].pop()
+                for d in self.deques:
+                    if d:
+                        return d.popleft()
+                if not self.pending:
+                    break
+                self.cond.wait()
+            return None
+
+    def done(self):
+        """Mark a directory from `get` as finished"""
+        with self.cond:
+            self.pending -= 1
+            if not self.pending:
+                self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+def crawl(path, workers=20, max_queued=10000, scanned=None):
+    """
+    Crawl a directory tree in parallel.
+
+    Directories are read with `os.scandir`, using the entry type from
+    the directory listing to find subdirectories, so the only other
+    syscall is one `lstat` per file (and a `readlink` per symlink).
+    Symlinks are returned as files, and never followed.
+
+    Args:
+        path (str or list): the directory to crawl, or several directories
+        workers (int): the number of directories to scan at once
+        max_queued (int): the most results to buffer before workers wait
+        scanned (callable): (optional) called as `scanned(dir, subdirs, entries)`
+                            once each directory is read, before its
+                            entries are returned or its subdirs are crawled
+
+    Yields:
+        Entry: every non-directory
+    """
+    work = WorkQueue(workers)
+    results = queue.Queue(maxsize=max_queued)
+    done = object()
+
+    def put(item):
+        while not work.stopped:
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def worker(n):
         try:
-            if os.path.isdir(p):
-                if os.path.islink(p):
-                    files.append(p)
-                dirs.append(p)
+            while True:
+                d = work.get(n)
+                if d is None:
+                    break
+                if scanned:
+                    subdirs, entries = [], []
+                    add_dir, add_entry = subdirs.append, entries.append
+                else:
+                    add_dir, add_entry = partial(work.put, n), put
+                try:
+                    with os.scandir(d) as it:
+                        for entry in it:
+                            try:
+                                if entry.is_dir(follow_symlinks=False):
+                                    add_dir(entry.path)
+                                else:
+                                    add_entry(Entry.from_path(entry.path, entry.stat(follow_symlinks=False)))
+                            except OSError:
+                                logger.warning("error reading %s", entry.path, exc_info=True)
+                except OSError:
+                    logger.warning("error reading dir %s", d, exc_info=True)
+                finally:
+                    if scanned:
+                        try:
+                            scanned(d, subdirs, entries)
+                        except Exception:
+                            logger.warning("error recording dir %s", d, exc_info=True)
+                        for s in subdirs:
+                            work.put(n, s)
+                        for e in entries:
+                            put(e)
+                    work.done()
+        finally:
+            put(done)
+
+    for p in ([path] if isinstance(path, str) else path):
+        work.put(0, p)
+    threads = [Thread(target=worker, args=(n,), daemon=True) for n in range(workers)]
+    for t in threads:
+        t.start()
+    try:
+        running = workers
+        while running:
+            item = results.get()
+            if item is done:
+                running -= 1
             else:
-                files.append(p)
-        except Exception:
-            logger.warning("error reading %s", p, exc_info=True)
-    logger.info('done reading dir: %s',path)
-    return dirs,files
-
-def generate_files(path):
-    dirs = [path]
-    pool = ThreadPool(20)
-
-    while dirs:
-        logger.info('starting dir loop: %r', dirs)
-        dirs_results = pool.imap_unordered(listdir, dirs, chunksize=1)
-        dirs = []
-        for d,f in dirs_results:
-            dirs.extend(d)
-            for ff in f:
-                yield ff
-
-    logger.warning('done reading dirs')
-    pool.close()
+                yield item
+        logger.info('done reading dirs')
+    finally:
+        work.stop()
+
+def generate_files(path, workers=20):
+    for entry in crawl(path, workers):
+        yield entry.path
 
 def batch_files(global_path):
     pool = ThreadPool(100)
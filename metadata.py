@@ -0,0 +1,325 @@
+"""
+The metadata database.
+"""
+
+import os
+import time
+import json
+import hashlib
+import queue
+import sqlite3
+import threading
+import weakref
+import logging
+
+import metrics
+
+logger = logging.getLogger('metadata')
+
+TABLES = {
+    'files': 'CREATE TABLE IF NOT EXISTS files (path, size, type, date_modified, link_path, sha256sum, chunk_checksums, chunk_sizes, snapshot DEFAULT 0, parent)',
+    'directories': 'CREATE TABLE IF NOT EXISTS directories (id INTEGER PRIMARY KEY, parent, path)',
+    'stat_index': 'CREATE TABLE IF NOT EXISTS stat_index (path PRIMARY KEY, size, mtime, inode, snapshot)',
+    'snapshots': 'CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY, date)',
+    'bundled': 'CREATE TABLE IF NOT EXISTS bundled (checksum PRIMARY KEY, bundle, offset, length)',
+    'chunks': 'CREATE TABLE IF NOT EXISTS chunks (key PRIMARY KEY, size, refcount)',
+    'sync_log': 'CREATE TABLE IF NOT EXISTS sync_log (id INTEGER PRIMARY KEY AUTOINCREMENT, statement, params)',
+    'sync_state': 'CREATE TABLE IF NOT EXISTS sync_state (key PRIMARY KEY, value)',
+    # the journal of unfinished upload runs, so a stopped run can continue
+    'upload_jobs': 'CREATE TABLE IF NOT EXISTS upload_jobs (path PRIMARY KEY, snapshot)',
+    'upload_dirs': 'CREATE TABLE IF NOT EXISTS upload_dirs (path PRIMARY KEY, job)',
+    'upload_files': 'CREATE TABLE IF NOT EXISTS upload_files (path PRIMARY KEY, job, size, mtime, inode)',
+    'upload_chunks': 'CREATE TABLE IF NOT EXISTS upload_chunks (path, n, checksum, size, PRIMARY KEY (path, n))',
+}
+INDEXES = [
+    'CREATE UNIQUE INDEX IF NOT EXISTS path_snapshot_index on files (path, snapshot)',
+    'CREATE INDEX IF NOT EXISTS snapshot_index on files (snapshot)',
+    'CREATE INDEX IF NOT EXISTS parent_index on files (parent, path, snapshot)',
+    'CREATE INDEX IF NOT EXISTS directory_parent_index on directories (parent, path)',
+    'CREATE INDEX IF NOT EXISTS upload_dirs_index on upload_dirs (job)',
+    'CREATE INDEX IF NOT EXISTS upload_files_index on upload_files (job)',
+]
+
+
+def dir_id(path):
+    """Get the id of a directory, from a hash of its path"""
+    return int.from_bytes(hashlib.sha256(path.encode('utf-8', 'surrogateescape')).digest()[:8], 'big') >> 1
+
+def ancestors(path):
+    """Yield a directory and each of its parents, as (id, parent id, path)"""
+    while True:
+        parent = os.path.dirname(path)
+        if parent == path:
+            yield dir_id(path), None, path
+            return
+        yield dir_id(path), dir_id(parent), path
+        path = parent
+
+def subtree(path):
+    """
+    Get the range of path keys under a directory.
+
+    Returns:
+        tuple: (low, high), for `path >= low AND path < high`
+    """
+    path = path.rstrip('/')
+    # '0' sorts right after '/'
+    return path+'/', path+'0'
+
+
+class _Connection:
+    """A thread's connection, closed once the thread exits and drops it"""
+    def __init__(self, db):
+        self.db = db
+
+
+class Metadata:
+    """
+    The metadata database.
+
+    All writes go through a single writer thread, which batches them
+    into one transaction every `batch_size` writes or `batch_time`
+    seconds, whichever comes first.  Each write (a list of statements)
+    is applied atomically.  Reads use one connection per thread, and
+    may not see writes from the current batch until it commits.  A
+    thread's connection is closed when the thread exits.
+
+    The database is in WAL mode, so reads never wait on the writer.
+    When another process holds the write lock, the writer waits up to
+    `busy_timeout` seconds, and tries again `busy_retries` times.
+
+    A write that fails is rolled back, and the error is raised by the
+    next call to `write`, `flush`, or `close`.
+
+    Every logged write is also recorded in the `sync_log` table, so the
+    changes since the last sync can be shipped elsewhere and replayed.
+
+    Args:
+        filename (str): the sqlite database file
+        batch_size (int): writes per transaction
+        batch_time (float): maximum seconds before a commit
+    """
+    busy_timeout = 30. # seconds to wait for a lock held by another connection
+    busy_retries = 5
+
+    def __init__(self, filename, batch_size=1000, batch_time=1.0):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.batch_time = batch_time
+        self.connections = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.error = None
+
+        db = self._connect()
+        db.execute('PRAGMA journal_mode=WAL')
+        existing = set(row[0] for row in db.execute('SELECT name FROM sqlite_master WHERE type = "table"'))
+        self.created = set(TABLES) - existing
+        for sql in TABLES.values():
+            db.execute(sql)
+        columns = [row[1] for row in db.execute('PRAGMA table_info(files)')]
+        if 'chunk_sizes' not in columns:
+            db.execute('ALTER TABLE files ADD COLUMN chunk_sizes')
+        if 'snapshot' not in columns:
+            # rows from before snapshots are in every snapshot
+            db.execute('ALTER TABLE files ADD COLUMN snapshot DEFAULT 0')
+        if 'parent' not in columns:
+            db.execute('ALTER TABLE files ADD COLUMN parent')
+            self._index_tree(db)
+        columns = [row[1] for row in db.execute('PRAGMA table_info(stat_index)')]
+        if 'snapshot' not in columns:
+            db.execute('ALTER TABLE stat_index ADD COLUMN snapshot')
+        # a path has a row per version now
+        db.execute('DROP INDEX IF EXISTS path_index')
+        for sql in INDEXES:
+            db.execute(sql)
+
+        self.queue = queue.Queue(maxsize=batch_size*10)
+        metrics.gauge('metadata_queue', self.queue.qsize)
+        self.writer = threading.Thread(target=self._writer, daemon=True)
+        self.writer.start()
+
+    @staticmethod
+    def _index_tree(db):
+        """Fill in the directory tree, for databases from before it"""
+        db.create_function('dir_id', 1, dir_id, deterministic=True)
+        db.create_function('dirname', 1, os.path.dirname, deterministic=True)
+        db.execute('BEGIN')
+        db.execute('UPDATE files SET parent = dir_id(dirname(path))')
+        for path, in db.execute('SELECT DISTINCT dirname(path) FROM files').fetchall():
+            db.executemany('INSERT OR IGNORE INTO directories (id, parent, path) values (?,?,?)', ancestors(path))
+        db.execute('COMMIT')
+
+    def _connect(self):
+        db = sqlite3.connect(self.filename, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+        db.execute('PRAGMA synchronous=NORMAL')
+        with self.lock:
+            self.connections.append(db)
+        return db
+
+    def _db(self):
+        """Get the connection for this thread"""
+        try:
+            return self.local.connection.db
+        except AttributeError:
+            db = self._connect()
+            self.local.connection = _Connection(db)
+            weakref.finalize(self.local.connection, self._release, db)
+            return db
+
+    def _release(self, db):
+        with self.lock:
+            if db in self.connections:
+                self.connections.remove(db)
+        db.close()
+
+    def query(self, sql, params=()):
+        """Run a query, returning all rows"""
+        return self._db().execute(sql, params).fetchall()
+
+    def iterate(self, sql, params=()):
+        """Run a query, yielding rows one at a time"""
+        yield from self._db().execute(sql, params)
+
+    def write(self, statements, log=True):
+        """
+        Queue statements to be written in one atomic step.
+
+        Args:
+            statements (iterable): (sql, params) tuples
+            log (bool): record the statements in the sync log
+        """
+        if isinstance(statements, (list, tuple)):
+            statements = list(statements)
+        self._raise()
+        self.queue.put((statements, log))
+
+    def get_state(self, key, default=None):
+        """Get a value from the sync state"""
+        ret = self.query('SELECT value FROM sync_state WHERE key = ?', (key,))
+        return ret[0][0] if ret else default
+
+    def set_state(self, key, value):
+        """Queue setting a value in the sync state"""
+        self.write([('INSERT OR REPLACE INTO sync_state (key, value) values (?,?)', (key, value))], log=False)
+
+    def dump_log(self, fileobj):
+        """
+        Write the sync log to a file, as one json statement per line.
+
+        Args:
+            fileobj (file): a file opened in binary mode
+
+        Returns:
+            int: the id of the last statement written, or None if the log is empty
+        """
+        last = None
+        for last, sql, params in self.iterate('SELECT id, statement, params FROM sync_log ORDER BY id'):
+            fileobj.write(json.dumps([sql, json.loads(params)]).encode('utf-8')+b'\n')
+        return last
+
+    @staticmethod
+    def load_log(fileobj):
+        """Read statements written by `dump_log`"""
+        for line in fileobj:
+            sql, params = json.loads(line)
+            yield sql, tuple(params)
+
+    def flush(self):
+        """Wait until everything written so far is committed"""
+        e = threading.Event()
+        self.queue.put(e)
+        e.wait()
+        self._raise()
+
+    def close(self):
+        """Commit everything, then close the database"""
+        self.queue.put(None)
+        self.writer.join()
+        with self.lock:
+            for db in self.connections:
+                db.close()
+            self.connections = []
+        self._raise()
+
+    def _raise(self):
+        """Raise the first error from the writer since the last one was raised"""
+        with self.lock:
+            error, self.error = self.error, None
+        if error:
+            raise error
+
+    def _failed(self, e):
+        logger.error('error writing metadata', exc_info=True)
+        with self.lock:
+            if not self.error:
+                self.error = e
+
+    def _execute(self, db, sql):
+        """Run a statement, trying again while another connection holds the lock"""
+        delay = 0.1
+        for attempt in range(self.busy_retries):
+            try:
+                return db.execute(sql)
+            except sqlite3.OperationalError as e:
+                code = getattr(e, 'sqlite_errorcode', sqlite3.SQLITE_BUSY) & 0xff
+                if code not in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED) or attempt == self.busy_retries-1:
+                    raise
+                logger.warning('metadata database is locked, trying again')
+                time.sleep(delay)
+                delay *= 2
+
+    def _writer(self):
+        db = self._connect()
+        pending = 0
+        deadline = 0
+        while True:
+            try:
+                timeout = max(deadline-time.monotonic(), 0) if pending else None
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            try:
+                if isinstance(item, tuple):
+                    statements, log = item
+                    if not pending:
+                        # take the write lock now, so the transaction
+                        # cannot be refused when it starts writing
+                        self._execute(db, 'BEGIN IMMEDIATE')
+                        deadline = time.monotonic()+self.batch_time
+                    db.execute('SAVEPOINT write')
+                    try:
+                        for sql, params in statements:
+                            db.execute(sql, params)
+                            if log:
+                                db.execute('INSERT INTO sync_log (statement, params) values (?,?)',
+                                           (sql, json.dumps(params)))
+                    except Exception as e:
+                        db.execute('ROLLBACK TO write')
+                        self._failed(e)
+                    db.execute('RELEASE write')
+                    pending += 1
+                    if pending < self.batch_size:
+                        continue
+                if pending:
+                    with metrics.timer('metadata_commit'):
+                        self._execute(db, 'COMMIT')
+                    metrics.add('metadata_writes', pending)
+                    pending = 0
+            except Exception as e:
+                # the whole batch is lost
+                if db.in_transaction:
+                    try:
+                        db.execute('ROLLBACK')
+                    except sqlite3.Error:
+                        logger.warning('cannot roll back metadata', exc_info=True)
+                pending = 0
+                self._failed(e)
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                try:
+                    db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                except sqlite3.Error as e:
+                    self._failed(e)
+                break
@@ -0,0 +1,206 @@
+"""
+Counters and latency histograms for each stage of the archiver.
+"""
+
+import os
+import time
+import bisect
+import threading
+import contextlib
+import logging
+
+logger = logging.getLogger('metrics')
+
+PREFIX = 's3_archive_'
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60) # seconds
+
+
+class Histogram:
+    """A latency histogram, with the total bytes seen"""
+    def __init__(self):
+        self.buckets = [0]*(len(BUCKETS)+1)
+        self.count = 0
+        self.sum = 0.
+        self.bytes = 0
+
+    def observe(self, seconds, size=0):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.bytes += size
+
+
+class Metrics:
+    """
+    Per-stage counters, latency histograms, and gauges.
+
+    Stages are timed with `timer` or `observe`, which record the
+    latency, the number of operations, and the bytes handled.  Gauges
+    are functions read when a report is made, such as queue depths.
+
+    `report` gives a log line of the rates since the last report, and
+    `prometheus` gives all metrics in the Prometheus text format.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.gauges = {}
+        self.reset()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def reset(self):
+        """Forget all counters and histograms"""
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.last = ({}, time.monotonic())
+
+    def add(self, name, n=1):
+        """Add to a counter"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds, size=0):
+        """Record one operation of a stage"""
+        with self.lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = Histogram()
+            h.observe(seconds, size)
+
+    @contextlib.contextmanager
+    def timer(self, name, size=0):
+        """
+        Time one operation of a stage.  Failed operations are only
+        counted, as `<name>_errors`.
+
+        Args:
+            name (str): the stage
+            size (int): (optional) the bytes handled
+        """
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException:
+            self.add(name+'_errors')
+            raise
+        self.observe(name, time.monotonic()-start, size)
+
+    def gauge(self, name, func):
+        """Set a function giving the current value of a gauge"""
+        with self.lock:
+            self.gauges[name] = func
+
+    def _gauges(self):
+        with self.lock:
+            gauges = sorted(self.gauges.items())
+        ret = {}
+        for name, func in gauges:
+            try:
+                ret[name] = func()
+            except Exception:
+                logger.debug('cannot read gauge %s', name, exc_info=True)
+        return ret
+
+    def report(self):
+        """
+        Get the rates since the last report.
+
+        Returns:
+            str: a log line, with ops/s and MB/s for each stage, and the gauges
+        """
+        now = time.monotonic()
+        with self.lock:
+            totals = {name: (h.count, h.bytes, h.sum) for name, h in self.histograms.items()}
+            totals.update((name, (n, 0, 0)) for name, n in self.counters.items())
+            last, start = self.last
+            self.last = (totals, now)
+        elapsed = max(now-start, 1e-9)
+        parts = []
+        for name, (count, size, seconds) in sorted(totals.items()):
+            prev = last.get(name, (0, 0, 0))
+            if count == prev[0]:
+                continue
+            part = '%s %.1f/s' % (name, (count-prev[0])/elapsed)
+            if size != prev[1]:
+                part += ' %.1fMB/s' % ((size-prev[1])/elapsed/1048576)
+            if seconds != prev[2]:
+                part += ' %.3fs avg' % ((seconds-prev[2])/(count-prev[0]))
+            parts.append(part)
+        parts.extend('%s %s' % g for g in self._gauges().items())
+        return ', '.join(parts)
+
+    def prometheus(self):
+        """Get all metrics in the Prometheus text format"""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((name, h.count, h.sum, h.bytes, list(h.buckets))
+                                for name, h in self.histograms.items())
+        for name, n in counters:
+            lines.append('# TYPE %s%s_total counter' % (PREFIX, name))
+            lines.append('%s%s_total %d' % (PREFIX, name, n))
+        for name, count, seconds, size, buckets in histograms:
+            lines.append('# TYPE %s%s_seconds histogram' % (PREFIX, name))
+            n = 0
+            for bound, c in zip(BUCKETS+('+Inf',), buckets):
+                n += c
+                lines.append('%s%s_seconds_bucket{le="%s"} %d' % (PREFIX, name, bound, n))
+            lines.append('%s%s_seconds_sum %f' % (PREFIX, name, seconds))
+            lines.append('%s%s_seconds_count %d' % (PREFIX, name, count))
+            lines.append('# TYPE %s%s_bytes_total counter' % (PREFIX, name))
+            lines.append('%s%s_bytes_total %d' % (PREFIX, name, size))
+        for name, value in self._gauges().items():
+            lines.append('# TYPE %s%s gauge' % (PREFIX, name))
+            lines.append('%s%s %s' % (PREFIX, name, value))
+        return '\n'.join(lines)+'\n'
+
+    def write(self, filename):
+        """Write the Prometheus text format to a file, replacing it atomically"""
+        tmp = filename+'.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp, filename)
+
+    def start(self, interval, filename=None):
+        """
+        Log a report every `interval` seconds, in a background thread.
+
+        Args:
+            interval (float): seconds between reports
+            filename (str): (optional) a file to also write the Prometheus text to
+        """
+        if self.thread or not interval:
+            return
+        self.stopped.clear()
+        def run():
+            while not self.stopped.wait(interval):
+                self.log(filename)
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def stop(self, filename=None):
+        """Stop the background reports, then make a last one"""
+        if self.thread:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+        self.log(filename)
+
+    def log(self, filename=None):
+        line = self.report()
+        if line:
+            logger.info('%s', line)
+        if filename:
+            try:
+                self.write(filename)
+            except OSError:
+                logger.warning('cannot write metrics to %s', filename, exc_info=True)
+
+
+# the metrics of this process
+stats = Metrics()
+add = stats.add
+observe = stats.observe
+timer = stats.timer
+gauge = stats.gauge
@@ -0,0 +1,98 @@
+"""
+Read archived files without restoring them.
+"""
+
+import io
+import bisect
+import itertools
+import collections
+import logging
+
+import util
+
+logger = logging.getLogger('reader')
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    A read-only, seekable file object over the chunks of an archived file.
+
+    Chunks are only fetched when a read needs them.  Decoding starts at
+    the beginning of a chunk, so a chunk is fetched up to the end of the
+    read, and at least twice as far each time more of it is needed.
+    Decoded chunks are kept in spooled temporary files, for the last
+    `cache_size` chunks read.
+
+    Wrap it in `io.BufferedReader` for `read()`, `readline()` and friends.
+
+    Args:
+        fetch (callable): fetch(index, fileobj, start, end) writes bytes
+                          `start` to `end` of chunk `index` to fileobj
+        sizes (list): the size of each chunk
+        cache_size (int): the number of decoded chunks to keep
+    """
+    def __init__(self, fetch, sizes, cache_size=4):
+        self.fetch = fetch
+        self.sizes = sizes
+        self.offsets = list(itertools.accumulate(sizes, initial=0))
+        self.size = self.offsets[-1]
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('negative seek position %d' % offset)
+        self.pos = offset
+        return offset
+
+    def _chunk(self, index, end):
+        """Get a file holding at least the first `end` bytes of a chunk"""
+        f, length = self.cache.pop(index, (None, 0))
+        if length < end:
+            if f:
+                f.close()
+            end = min(max(end, length*2), self.sizes[index])
+            f = util.spool()
+            try:
+                self.fetch(index, f, 0, end)
+            except Exception:
+                f.close()
+                raise
+            length = end
+        self.cache[index] = (f, length)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)[1][0].close()
+        return f
+
+    def readinto(self, b):
+        if self.pos >= self.size:
+            return 0
+        index = bisect.bisect_right(self.offsets, self.pos) - 1
+        start = self.pos - self.offsets[index]
+        n = min(len(b), self.sizes[index] - start)
+        f = self._chunk(index, start+n)
+        f.seek(start)
+        data = f.read(n)
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def close(self):
+        for f, length in self.cache.values():
+            f.close()
+        self.cache.clear()
+        super().close()
@@ -0,0 +1,175 @@
+"""
+Schedule upload work in lanes, under shared rate limits.
+"""
+
+import threading
+import concurrent.futures
+import logging
+
+import metrics
+import util
+
+logger = logging.getLogger('scheduler')
+
+# setting name for each rate limit
+LIMITS = {
+    'read': 'read-bandwidth',
+    'upload': 'upload-bandwidth',
+    'requests': 's3-requests-per-second',
+}
+
+
+class Lane:
+    """
+    A thread pool with a bounded backlog.
+
+    `submit` waits while `backlog` tasks are queued or running.  The
+    first error from a task is raised by the next `submit` or `join`.
+
+    An error also sets `stop`, after which queued tasks are skipped
+    instead of run, until `join` returns.
+
+    Args:
+        name (str): the lane name
+        threads (int): the number of tasks to run at once
+        backlog (int): the most tasks queued or running
+        stop (threading.Event): (optional) the stop flag, to share with other lanes
+    """
+    def __init__(self, name, threads, backlog, stop=None):
+        self.name = name
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix=name)
+        self.slots = threading.BoundedSemaphore(backlog)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.error = None
+        self.stop = stop or threading.Event()
+
+    def _raise(self):
+        with self.lock:
+            error, self.error = self.error, None
+        if error:
+            raise error
+
+    def submit(self, fn, *args):
+        self._raise()
+        if self.stop.is_set():
+            return
+        self.slots.acquire()
+        try:
+            with self.lock:
+                fut = self.executor.submit(self._run, fn, *args)
+                self.pending.add(fut)
+        except Exception:
+            self.slots.release()
+            raise
+        fut.add_done_callback(self._done)
+
+    def _run(self, fn, *args):
+        if not self.stop.is_set():
+            fn(*args)
+
+    def _done(self, fut):
+        with self.lock:
+            self.pending.discard(fut)
+            if not fut.cancelled() and fut.exception():
+                self.stop.set()
+                if not self.error:
+                    self.error = fut.exception()
+        self.slots.release()
+
+    def cancel(self):
+        """Stop, and cancel the tasks that have not started"""
+        self.stop.set()
+        with self.lock:
+            pending = list(self.pending)
+        for fut in pending:
+            fut.cancel()
+
+    def join(self):
+        """Wait for every task submitted so far, or until they are cancelled"""
+        while True:
+            if self.stop.is_set():
+                self.cancel()
+            with self.lock:
+                pending = list(self.pending)
+            if not pending:
+                break
+            concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_EXCEPTION)
+        self._raise()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class Scheduler:
+    """
+    Run upload work in separate lanes, so one kind of work cannot hold
+    up the others, and limit the load on the filesystem and network.
+
+    The lanes are "metadata" (stat checks, links, and handing off files),
+    "small" (small files), and "large" (large files, whose chunks are
+    uploaded while they are read).  A large file only takes a large
+    lane thread, so small files keep moving around it.
+
+    The rate limits are TokenBuckets shared by every lane: file reads
+    (bytes/s), uploads (bytes/s), and S3 requests (/s).  They can be
+    changed while running, with `configure`.
+
+    An error in any lane stops every lane: tasks not started yet are
+    cancelled, as they are by `cancel`.
+
+    Args:
+        settings (dict): the settings
+    """
+    def __init__(self, settings):
+        small = settings.get('upload-threads', 20)
+        large = settings.get('large-file-threads', 4)
+        meta = settings.get('metadata-threads', 4)
+        self.stop = threading.Event()
+        self.lanes = {
+            'metadata': Lane('metadata', meta, meta*4, self.stop),
+            'small': Lane('small', small, small*4, self.stop),
+            # large files waiting are only paths, so let many queue up
+            # instead of holding up the metadata lane
+            'large': Lane('large', large, 10000, self.stop),
+        }
+        for name, lane in self.lanes.items():
+            metrics.gauge('lane_'+name, lambda lane=lane: len(lane.pending))
+        self.limits = {name: util.TokenBucket(None) for name in LIMITS}
+        self.configure(settings)
+
+    def configure(self, settings):
+        """Set the rate limits from the settings.  A limit not in the settings is removed."""
+        for name, key in LIMITS.items():
+            rate = settings.get(key, None)
+            if rate != self.limits[name].rate:
+                logger.info('%s limit: %s', name, rate or 'none')
+                self.limits[name].set_rate(rate)
+
+    def submit(self, lane, fn, *args):
+        """Run `fn(*args)` in a lane, waiting if its backlog is full"""
+        self.lanes[lane].submit(fn, *args)
+
+    def cancel(self):
+        """Stop every lane, cancelling the tasks that have not started"""
+        for lane in self.lanes.values():
+            lane.cancel()
+
+    def join(self):
+        """
+        Wait for the work in every lane, in the order work flows between
+        them.  Once every lane is done, the lanes can take work again.
+        """
+        error = None
+        for name in ('metadata', 'small', 'large'):
+            try:
+                self.lanes[name].join()
+            except Exception as e:
+                error = error or e
+        self.stop.clear()
+        if error:
+            raise error
+
+    def shutdown(self):
+        for lane in self.lanes.values():
+            lane.shutdown()
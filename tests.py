@@ -8,14 +8,32 @@ import random
 import string
 import logging
 import subprocess
+import sqlite3
+import hashlib
+import base64
+import io
+import argparse
+import threading
+import collections
+import concurrent.futures
+import time
 from unittest.mock import patch, MagicMock
 
 from cryptography.fernet import Fernet
+import zstd
 import boto3
 from botocore.exceptions import ClientError
 
 import util
+import chunker
+import crawler
+import cache
+import metadata
+import reader
+import scheduler
 import archive
+import benchmark
+import metrics
 
 class TestUtil(unittest.TestCase):
     def setUp(self):
@@ -63,6 +81,601 @@ class TestUtil(unittest.TestCase):
         cksm2 = util.sha512sum(filename)
         self.assertEqual(cksm, cksm2)
 
+    def test_encrypt_frames(self):
+        data = os.urandom(10000)
+        e = util.Encrypt(Fernet.generate_key())
+        e.frame_size = 1000
+        tmp = e.encode(data)
+        self.assertEqual(tmp[:3], util.MAGIC)
+        self.assertEqual(data, e.decode(tmp))
+        with self.assertRaises(Exception):
+            e.decode(tmp[:-1000])
+        with self.assertRaises(Exception):
+            e.decode(tmp[:-1]+bytes([tmp[-1]^1]))
+
+    def test_encrypt_raw(self):
+        e = util.Encrypt(Fernet.generate_key())
+        e.frame_size = 100000
+        random_data = os.urandom(100000)
+        text = b'hello world ' * 10000
+        # incompressible data is stored raw, with no zstd overhead
+        tmp = e.encode(random_data)
+        self.assertEqual(tmp[len(util.MAGIC)+1+util.SALT_SIZE] & util.FRAME_RAW, util.FRAME_RAW)
+        self.assertEqual(random_data, e.decode(tmp))
+        tmp = e.encode(text)
+        self.assertEqual(tmp[len(util.MAGIC)+1+util.SALT_SIZE] & util.FRAME_RAW, 0)
+        self.assertLess(len(tmp), len(text))
+        self.assertEqual(text, e.decode(tmp))
+        # level 0 turns compression off
+        out = io.BytesIO()
+        enc = e.encoder(out, 0)
+        enc.write(text)
+        enc.close()
+        self.assertGreater(len(out.getvalue()), len(text))
+        self.assertEqual(text, e.decode(out.getvalue()))
+
+    def test_encrypt_salt(self):
+        key = Fernet.generate_key()
+        e = util.Encrypt(key)
+        data = b'hello world ' * 1000
+        # each object has its own salt, and so its own key
+        a, b = e.encode(data), e.encode(data)
+        header = len(util.MAGIC)+1+util.SALT_SIZE
+        self.assertNotEqual(a[:header], b[:header])
+        self.assertNotEqual(a[header:], b[header:])
+        self.assertEqual(data, e.decode(a))
+        # the salt is authenticated
+        with self.assertRaises(Exception):
+            e.decode(a[:header-1]+bytes([a[header-1]^1])+a[header:])
+
+    def test_auto_level(self):
+        a = util.AutoLevel(5, 1000)
+        a.update(100, 1)
+        self.assertEqual(a.level, 4)
+        a.update(100000, 1)
+        a.update(100000, 1)
+        self.assertEqual(a.level, 5)
+        for _ in range(10):
+            a.update(1, 1)
+        self.assertEqual(a.level, 1)
+        e = util.Encrypt(Fernet.generate_key(), 3, 1e15)
+        data = b'hello world ' * 10000
+        self.assertEqual(data, e.decode(e.encode(data)))
+        self.assertEqual(e.auto.level, 2)
+
+    def test_encrypt_pool(self):
+        e = util.Encrypt(Fernet.generate_key())
+        e.frame_size = 1000
+        e.start_pool(2)
+        try:
+            with patch.object(util.Encoder, 'pool_min', 500):
+                for data in (os.urandom(10000), b'hello world ' * 1000, b'', os.urandom(10100)):
+                    self.assertEqual(data, e.decode(e.encode(data)))
+            # every slot is given back
+            for _ in range(4):
+                self.assertTrue(e.slots.acquire(blocking=False))
+            self.assertFalse(e.slots.acquire(blocking=False))
+            for _ in range(4):
+                e.slots.release()
+            # small frames are encoded inline
+            with patch.object(e.pool, 'submit', wraps=e.pool.submit) as submit:
+                data = b'hello world ' * 1000
+                self.assertEqual(data, e.decode(e.encode(data)))
+                self.assertFalse(submit.called)
+        finally:
+            e.stop_pool()
+
+    def test_content_cache(self):
+        c = util.ContentCache(size=2)
+        fut, new = c.claim('a')
+        self.assertTrue(new)
+        self.assertEqual(c.claim('a'), (fut, False))
+        fut.set_result('a')
+        fut, new = c.claim('b')
+        fut.set_exception(Exception())
+        # failed keys can be claimed again
+        self.assertIsNone(c.get('b'))
+        for k in 'bc':
+            c.claim(k)[0].set_result(k)
+        # stored keys are an LRU
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(c.get('c').result(), 'c')
+
+    def test_tee_writer(self):
+        a, b = io.BytesIO(), io.BytesIO()
+        t = util.TeeWriter(a, b, 5)
+        for data in (b'abc', b'defg', b'', b'hij'):
+            self.assertEqual(t.write(data), len(data))
+        self.assertEqual(a.getvalue(), b'abcdefghij')
+        self.assertEqual(b.getvalue(), b'fghij')
+
+    def test_token_bucket(self):
+        b = util.TokenBucket(1000, burst=100)
+        start = time.monotonic()
+        b.take(100)
+        b.take(200)
+        b.take(100)
+        # the burst is free, the rest waits at the rate
+        self.assertGreaterEqual(time.monotonic()-start, 0.25)
+        b = util.TokenBucket(None)
+        b.take(10**12)
+        # the rate can change while in use
+        b.set_rate(1000, burst=100)
+        start = time.monotonic()
+        b.take(300)
+        self.assertGreaterEqual(time.monotonic()-start, 0.15)
+        b.set_rate(None)
+        start = time.monotonic()
+        b.take(10**12)
+        self.assertLess(time.monotonic()-start, 0.1)
+
+    def test_decode_range(self):
+        e = util.Encrypt(Fernet.generate_key())
+        e.frame_size = 1000
+        data = os.urandom(5500)
+        tmp = e.encode(data)
+        for start, end in ((0, None), (0, 10), (999, 1001), (2500, 5500), (5000, 9000)):
+            out = io.BytesIO()
+            e.decode_stream(io.BytesIO(tmp), out, start, end)
+            self.assertEqual(out.getvalue(), data[start:end])
+        # reading stops at the frame holding the end
+        fin = io.BytesIO(tmp)
+        e.decode_stream(fin, io.BytesIO(), 0, 1500)
+        self.assertLess(fin.tell(), len(tmp)//2)
+
+    def test_encrypt_legacy(self):
+        data = os.urandom(10000)
+        key = Fernet.generate_key()
+        e = util.Encrypt(key)
+        tmp = base64.urlsafe_b64decode(Fernet(key).encrypt(zstd.compress(data, 22)))
+        self.assertEqual(data, e.decode(tmp))
+
+    def test_read_chunks(self):
+        filename = 'testfile'
+        with open(filename, 'wb') as f:
+            for _ in range(1024):
+                f.write(os.urandom(1024))
+        total = hashlib.sha512()
+        chunks = []
+        with open(filename, 'rb') as f:
+            for cksm, size, data in util.read_chunks(f, chunker.Fixed(300000), total, 65536):
+                with data:
+                    chunks.append((cksm, size, data.read()))
+        self.assertEqual(len(chunks), 4)
+        for cksm, size, chunk in chunks:
+            self.assertEqual(cksm, hashlib.sha512(chunk).hexdigest())
+            self.assertEqual(size, len(chunk))
+        self.assertEqual(total.hexdigest(), util.sha512sum(filename))
+
+
+class TestChunker(unittest.TestCase):
+    def split(self, c, data, block=4096):
+        """Split data into chunks, feeding the chunker a block at a time"""
+        chunks = []
+        cur = b''
+        for i in range(0, len(data), block):
+            d = data[i:i+block]
+            while d:
+                n = c.boundary(d)
+                if n is None:
+                    cur += d
+                    break
+                chunks.append(cur+d[:n])
+                cur = b''
+                d = d[n:]
+        if cur:
+            chunks.append(cur)
+        return chunks
+
+    def test_fixed(self):
+        data = os.urandom(25000)
+        chunks = self.split(chunker.Fixed(10000), data)
+        self.assertEqual([len(c) for c in chunks], [10000, 10000, 5000])
+        self.assertEqual(b''.join(chunks), data)
+
+    def test_fastcdc(self):
+        data = random.Random(42).randbytes(200000)
+        chunks = self.split(chunker.FastCDC(2000, 8000, 20000), data)
+        self.assertEqual(b''.join(chunks), data)
+        for c in chunks[:-1]:
+            self.assertGreaterEqual(len(c), 2000)
+            self.assertLessEqual(len(c), 20000)
+
+        # an insert near the start only changes the first chunk
+        chunks2 = self.split(chunker.FastCDC(2000, 8000, 20000), data[:100]+b'x'+data[100:], block=999)
+        self.assertNotEqual(chunks[0], chunks2[0])
+        self.assertEqual(chunks[1:], chunks2[1:])
+
+    @unittest.skipIf(chunker.numpy is None, 'needs numpy')
+    def test_fastcdc_vector(self):
+        data = random.Random(42).randbytes(300000)
+        for sizes, block in (((2000, 8000, 20000), 4096), ((2000, 8000, 20000), 99999), ((16, 64, 256), 1000)):
+            with patch.object(chunker.FastCDC, 'scan_block', 1000):
+                chunks = self.split(chunker.FastCDC(*sizes), data, block)
+            # the same boundaries as the python loop
+            with patch.object(chunker, 'numpy', None):
+                self.assertEqual(self.split(chunker.FastCDC(*sizes), data, block), chunks)
+
+    def test_fastcdc_sizes(self):
+        with self.assertRaises(Exception):
+            chunker.FastCDC(8000, 2000, 20000)
+
+
+class TestCrawler(unittest.TestCase):
+    def setUp(self):
+        curdir = os.getcwd()
+        tmpdir = tempfile.mkdtemp(dir=curdir)
+        os.chdir(tmpdir)
+        def clean():
+            os.chdir(curdir)
+            shutil.rmtree(tmpdir)
+        self.addCleanup(clean)
+
+    def make_tree(self, base, depth=3, width=4):
+        """Make a tree of dirs, returning the files"""
+        files = []
+        for i in range(width):
+            name = os.path.join(base, 'f%d' % i)
+            with open(name, 'w') as f:
+                f.write(name)
+            files.append(name)
+            if depth:
+                name = os.path.join(base, 'd%d' % i)
+                os.mkdir(name)
+                files.extend(self.make_tree(name, depth-1, width))
+        return files
+
+    def test_crawl(self):
+        os.mkdir('src')
+        files = self.make_tree('src')
+        os.symlink(os.path.abspath('src/d0'), 'src/link')
+        files.append('src/link')
+        ret = {e.path: e for e in crawler.crawl('src', workers=4, max_queued=5)}
+        self.assertEqual(set(ret), set(files))
+        for path, e in ret.items():
+            st = os.lstat(path)
+            self.assertEqual((e.size, e.mtime, e.mode, e.inode, e.dev),
+                             (st.st_size, st.st_mtime_ns, st.st_mode, st.st_ino, st.st_dev))
+        self.assertTrue(ret['src/link'].is_link())
+        self.assertEqual(ret['src/link'].link, os.path.abspath('src/d0'))
+        self.assertTrue(ret['src/f0'].is_file())
+        with self.assertRaises(AttributeError):
+            ret['src/f0'].foo = 1
+
+    def test_crawl_scanned(self):
+        os.mkdir('src')
+        files = self.make_tree('src', depth=2)
+        dirs = {}
+        def scanned(d, subdirs, entries):
+            dirs[d] = (sorted(subdirs), sorted(e.path for e in entries))
+        # crawl only part of the tree
+        ret = [e.path for e in crawler.crawl(['src/d0', 'src/d1'], workers=4, scanned=scanned)]
+        self.assertEqual(sorted(ret), sorted(f for f in files if f.startswith(('src/d0/', 'src/d1/'))))
+        self.assertEqual(sorted(dirs), ['src/d0', 'src/d0/d0', 'src/d0/d1', 'src/d0/d2', 'src/d0/d3',
+                                        'src/d1', 'src/d1/d0', 'src/d1/d1', 'src/d1/d2', 'src/d1/d3'])
+        self.assertEqual(dirs['src/d0'], (['src/d0/d%d' % i for i in range(4)], ['src/d0/f%d' % i for i in range(4)]))
+
+    def test_crawl_stop(self):
+        os.mkdir('src')
+        self.make_tree('src')
+        for entry in crawler.crawl('src', workers=4, max_queued=1):
+            break
+
+
+class TestReader(unittest.TestCase):
+    def test_read(self):
+        chunks = [os.urandom(1000), os.urandom(500), b'', os.urandom(1500)]
+        fetched = []
+        def fetch(index, fileobj, start, end):
+            fetched.append((index, end))
+            fileobj.write(chunks[index][start:end])
+        with io.BufferedReader(reader.ChunkReader(fetch, [len(c) for c in chunks], cache_size=2), buffer_size=100) as f:
+            data = b''.join(chunks)
+            self.assertEqual(f.read(10), data[:10])
+            # only the start of the first chunk was fetched
+            self.assertEqual(fetched, [(0, 100)])
+            f.seek(900)
+            self.assertEqual(f.read(700), data[900:1600])
+            f.seek(-10, io.SEEK_END)
+            self.assertEqual(f.read(), data[-10:])
+            self.assertEqual(f.read(), b'')
+            f.seek(0)
+            self.assertEqual(f.read(), data)
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(dir=os.getcwd())
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_cache(self):
+        c = cache.ChunkCache(self.tmpdir, 2500)
+        out = io.BytesIO()
+        self.assertFalse(c.get('aa', out))
+        data = {k: os.urandom(1000) for k in ('aa', 'bb', 'cc')}
+        for k in ('aa', 'bb'):
+            with c.put(k) as f:
+                f.write(data[k])
+        self.assertTrue(c.get('aa', out))
+        self.assertEqual(out.getvalue(), data['aa'])
+        out = io.BytesIO()
+        self.assertTrue(c.get('bb', out, 10, 20))
+        self.assertEqual(out.getvalue(), data['bb'][10:20])
+
+        # another process sees the same chunks, and evicts the least recently used
+        c2 = cache.ChunkCache(self.tmpdir, 2500)
+        c2.get('aa', io.BytesIO())
+        with c2.put('cc') as f:
+            f.write(data['cc'])
+        self.assertFalse(c.get('bb', io.BytesIO()))
+        self.assertTrue(c.get('aa', io.BytesIO()))
+        self.assertTrue(c.get('cc', io.BytesIO()))
+        self.assertEqual(c.stats['hits'], 4)
+        self.assertEqual(c.stats['misses'], 2)
+        self.assertEqual(c2.stats['evictions'], 1)
+
+        # a failed write adds nothing
+        with self.assertRaises(Exception):
+            with c.put('dd') as f:
+                f.write(b'x')
+                raise Exception()
+        self.assertFalse(c.get('dd', io.BytesIO()))
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'dd')), [])
+
+        # the total size is kept as chunks come and go, without adding up every entry
+        self.assertEqual(c.size(), 2000)
+        with c.put('aa') as f:
+            f.write(b'x'*500)
+        self.assertEqual(c2.size(), 1500)
+        statements = []
+        c._db().set_trace_callback(statements.append)
+        with c.put('dd') as f:
+            f.write(data['cc']+b'x')
+        self.assertFalse([sql for sql in statements if 'sum(' in sql])
+        # over the limit, so the least recently used is evicted
+        self.assertEqual(c.size(), 1501)
+        self.assertFalse(c.get('cc', io.BytesIO()))
+        self.assertEqual(c.stats['evictions'], 1)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_metrics(self):
+        m = metrics.Metrics()
+        m.add('files', 3)
+        with m.timer('put', 1000):
+            pass
+        with self.assertRaises(ValueError):
+            with m.timer('put', 1000):
+                raise ValueError()
+        m.observe('put', 2, 3000)
+        m.gauge('queue', lambda: 7)
+        line = m.report()
+        self.assertIn('files ', line)
+        self.assertIn('queue 7', line)
+        # nothing new since the last report
+        self.assertEqual(m.report(), 'queue 7')
+
+        text = m.prometheus()
+        self.assertIn('s3_archive_files_total 3\n', text)
+        self.assertIn('s3_archive_put_errors_total 1\n', text)
+        self.assertIn('s3_archive_put_seconds_bucket{le="1"} 1\n', text)
+        self.assertIn('s3_archive_put_seconds_bucket{le="5"} 2\n', text)
+        self.assertIn('s3_archive_put_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('s3_archive_put_seconds_count 2\n', text)
+        self.assertIn('s3_archive_put_bytes_total 4000\n', text)
+        self.assertIn('s3_archive_queue 7\n', text)
+
+    def test_benchmark(self):
+        curdir = os.getcwd()
+        tmpdir = tempfile.mkdtemp(dir=curdir)
+        self.addCleanup(shutil.rmtree, tmpdir)
+        args = argparse.Namespace(small=20, small_size=1000, large=1, large_size=300000, dirs=2,
+                                  compressible=0.5, settings=None, dir=tmpdir, keep=False, interval=0,
+                                  s3_url=None, s3_access_key=None, s3_secret_key=None, s3_bucket='test')
+        filename = util.Settings.filename
+        db_filename = archive.Archive.db_filename
+        try:
+            results = benchmark.run(args)
+        finally:
+            util.Settings.filename = filename
+            archive.Archive.db_filename = db_filename
+        self.assertEqual(os.getcwd(), curdir)
+        self.assertEqual(results['upload']['stages']['crawl_files']['ops'], 21)
+        self.assertIn('s3_put', results['upload']['stages'])
+        self.assertIn('s3_get', results['restore']['stages'])
+        self.assertEqual(benchmark.compare(results, results, 0.2), [])
+        slow = {'upload': dict(results['upload'], **{'MB/s': results['upload']['MB/s']*2})}
+        self.assertEqual(len(benchmark.compare(results, slow, 0.2)), 1)
+
+class TestScheduler(unittest.TestCase):
+    def test_lanes(self):
+        s = scheduler.Scheduler({'upload-threads': 2, 'large-file-threads': 1})
+        try:
+            large = threading.Event()
+            done = []
+            # a stuck large file does not hold up the small files
+            s.submit('large', large.wait)
+            for i in range(20):
+                s.submit('small', done.append, i)
+            s.lanes['small'].join()
+            self.assertEqual(sorted(done), list(range(20)))
+            large.set()
+            def fail():
+                raise ValueError()
+            s.submit('metadata', s.submit, 'small', fail)
+            with self.assertRaises(ValueError):
+                s.join()
+            # the error is only raised once
+            s.join()
+        finally:
+            s.shutdown()
+
+    def test_lanes_cancel(self):
+        stop = threading.Event()
+        lanes = [scheduler.Lane(name, 1, 100, stop) for name in ('a', 'b')]
+        try:
+            started = threading.Event()
+            release = threading.Event()
+            def block():
+                started.set()
+                release.wait()
+            def fail():
+                raise ValueError()
+            done = []
+            lanes[0].submit(block)
+            started.wait()
+            lanes[0].submit(fail)
+            for i in range(10):
+                lanes[0].submit(done.append, i)
+                lanes[1].submit(done.append, i)
+            lanes[1].join()
+            release.set()
+            # an error stops both lanes, and the queued tasks do not run
+            with self.assertRaises(ValueError):
+                lanes[0].join()
+            lanes[1].submit(done.append, 'stopped')
+            lanes[1].join()
+            self.assertEqual(len(done), 10)
+
+            # cancelling skips what has not started
+            stop.clear()
+            release.clear()
+            started.clear()
+            lanes[0].submit(block)
+            started.wait()
+            for i in range(10):
+                lanes[0].submit(done.append, i)
+            lanes[0].cancel()
+            release.set()
+            lanes[0].join()
+            self.assertEqual(len(done), 10)
+        finally:
+            for lane in lanes:
+                lane.shutdown()
+
+        # the scheduler takes work again once joined
+        s = scheduler.Scheduler({})
+        try:
+            s.cancel()
+            s.join()
+            s.submit('small', done.append, 'after')
+            s.join()
+            self.assertEqual(done[-1], 'after')
+        finally:
+            s.shutdown()
+
+    def test_limits(self):
+        s = scheduler.Scheduler({'read-bandwidth': 1000})
+        try:
+            self.assertEqual(s.limits['read'].rate, 1000)
+            self.assertIsNone(s.limits['upload'].rate)
+            s.configure({'upload-bandwidth': 2000, 's3-requests-per-second': 10})
+            self.assertIsNone(s.limits['read'].rate)
+            self.assertEqual(s.limits['upload'].rate, 2000)
+            self.assertEqual(s.limits['requests'].rate, 10)
+        finally:
+            s.shutdown()
+
+class TestMetadata(unittest.TestCase):
+    def setUp(self):
+        curdir = os.getcwd()
+        tmpdir = tempfile.mkdtemp(dir=curdir)
+        os.chdir(tmpdir)
+        def clean():
+            os.chdir(curdir)
+            shutil.rmtree(tmpdir)
+        self.addCleanup(clean)
+
+    def test_batch(self):
+        m = metadata.Metadata('metadata.sqlite', batch_size=10, batch_time=60)
+        try:
+            self.assertEqual(m.created, set(metadata.TABLES))
+            self.assertEqual(m.query('PRAGMA journal_mode'), [('wal',)])
+            for i in range(5):
+                m.write([('INSERT INTO chunks (key, size, refcount) values (?,?,0)', (str(i), i))])
+            # not committed until the batch fills or is flushed
+            self.assertEqual(m.query('SELECT count(*) FROM chunks'), [(0,)])
+            m.flush()
+            self.assertEqual(m.query('SELECT count(*) FROM chunks'), [(5,)])
+        finally:
+            m.close()
+
+    def test_thread_connections(self):
+        m = metadata.Metadata('metadata.sqlite')
+        try:
+            counts = []
+            for _ in range(5):
+                with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+                    list(executor.map(lambda i: m.query('SELECT count(*) FROM files'), range(20)))
+                counts.append(len(m.connections))
+            # closed as their threads exit, so they do not pile up
+            self.assertEqual(len(set(counts)), 1)
+            self.assertLess(counts[0], 4)
+        finally:
+            m.close()
+
+    def test_atomic(self):
+        m = metadata.Metadata('metadata.sqlite')
+        try:
+            m.write([('INSERT INTO chunks (key, size, refcount) values (?,?,0)', ('a', 1))])
+            m.write([('INSERT INTO chunks (key, size, refcount) values (?,?,0)', ('b', 1)),
+                     ('INSERT INTO nothing values (?)', (1,))])
+            # the failed write is raised once
+            with self.assertRaises(sqlite3.OperationalError):
+                m.flush()
+            m.flush()
+            self.assertEqual(m.query('SELECT key FROM chunks'), [('a',)])
+            m.write([('INSERT INTO chunks (key, size, refcount) values (?,?,0)', ('c', 1))])
+        finally:
+            m.close()
+        with sqlite3.connect('metadata.sqlite') as db:
+            self.assertEqual(db.execute('SELECT key FROM chunks').fetchall(), [('a',), ('c',)])
+
+    def test_busy(self):
+        with patch.object(metadata.Metadata, 'busy_timeout', 0.05):
+            m = metadata.Metadata('metadata.sqlite')
+        m.busy_retries = 3
+        other = sqlite3.connect('metadata.sqlite', isolation_level=None, check_same_thread=False)
+        try:
+            # another process holds the write lock, for longer than the timeout
+            other.execute('BEGIN IMMEDIATE')
+            timer = threading.Timer(0.2, other.execute, ('COMMIT',))
+            timer.start()
+            m.write([('INSERT INTO chunks (key, size, refcount) values (?,?,0)', ('a', 1))])
+            m.flush()
+            timer.join()
+            self.assertEqual(m.query('SELECT key FROM chunks'), [('a',)])
+
+            # and until the retries run out
+            other.execute('BEGIN IMMEDIATE')
+            m.write([('INSERT INTO chunks (key, size, refcount) values (?,?,0)', ('b', 1))])
+            with self.assertRaises(sqlite3.OperationalError):
+                m.flush()
+            other.execute('COMMIT')
+            m.write([('INSERT INTO chunks (key, size, refcount) values (?,?,0)', ('c', 1))])
+            m.flush()
+            self.assertEqual(m.query('SELECT key FROM chunks ORDER BY key'), [('a',), ('c',)])
+        finally:
+            other.close()
+            m.close()
+
+    def test_upgrade(self):
+        with sqlite3.connect('metadata.sqlite') as db:
+            db.execute('CREATE TABLE files (path, size, type, date_modified, link_path, sha256sum, chunk_checksums)')
+            db.execute('CREATE UNIQUE INDEX path_index on files (path)')
+            db.execute('INSERT INTO files values ("/a/b/c",1,"file","","","abc","")')
+        m = metadata.Metadata('metadata.sqlite')
+        try:
+            # versions of a path, and a directory tree
+            m.write([('INSERT INTO files (path, snapshot) values (?,?)', ('/a/b/c', 1))])
+            m.flush()
+            self.assertEqual(m.query('SELECT snapshot FROM files ORDER BY snapshot'), [(0,), (1,)])
+            self.assertEqual(m.query('SELECT parent FROM files WHERE snapshot = 0'), [(metadata.dir_id('/a/b'),)])
+            self.assertEqual(m.query('SELECT path, parent FROM directories ORDER BY path'),
+                             [('/', None), ('/a', metadata.dir_id('/')), ('/a/b', metadata.dir_id('/a'))])
+        finally:
+            m.close()
+
 
 class TestArchive(unittest.TestCase):
     def setUp(self):
@@ -94,6 +707,36 @@ class TestArchive(unittest.TestCase):
             }, f)
         archive.Archive.db_filename = os.path.join(tmpdir, 'metadata.sqlite')
         archive.Archive.chunk_size = 10000
+        archive.Archive.bundle_file_size = 0
+
+    def fake_s3(self, s3_client):
+        """Keep uploaded objects in a dict, and serve downloads from it"""
+        uploads = {}
+        def upload_fileobj(Fileobj, Bucket, Key, **kwargs):
+            uploads[Key] = Fileobj.read()
+        def download_fileobj(Bucket, Key, Fileobj, **kwargs):
+            if Key not in uploads:
+                raise ClientError({},"download_fileobj")
+            Fileobj.write(uploads[Key])
+        def get_object(Bucket, Key, Range=None):
+            if Key not in uploads:
+                raise ClientError({},"get_object")
+            data = uploads[Key]
+            if Range:
+                start, end = map(int, Range.split('=')[1].split('-'))
+                data = data[start:end+1]
+            return {'Body': io.BytesIO(data)}
+        def paginate(Bucket, Prefix=''):
+            return [{'Contents': [{'Key': k, 'Size': len(v)} for k,v in sorted(uploads.items()) if k.startswith(Prefix)]}]
+        def delete_objects(Bucket, Delete):
+            for obj in Delete['Objects']:
+                del uploads[obj['Key']]
+        s3_client.return_value.upload_fileobj.side_effect = upload_fileobj
+        s3_client.return_value.download_fileobj.side_effect = download_fileobj
+        s3_client.return_value.get_object.side_effect = get_object
+        s3_client.return_value.get_paginator.return_value.paginate.side_effect = paginate
+        s3_client.return_value.delete_objects.side_effect = delete_objects
+        return uploads
 
     def make_dirs(self, base, N=100, M=100000, lambd=10000):
         """Make test dirs and files"""
@@ -115,10 +758,123 @@ class TestArchive(unittest.TestCase):
         ar = archive.Archive()
         ar.close()
 
+    @patch('boto3.client', autospec=True)
+    def test_metadata_sync(self, s3_client):
+        uploads = self.fake_s3(s3_client)
+        filenames = []
+        for i in range(3):
+            filenames.append('test%d' % i)
+            with open(filenames[-1], 'wb') as f:
+                f.write(os.urandom(1000))
+
+        # first run uploads a snapshot
+        ar = archive.Archive()
+        ar.upload_one(filenames[0])
+        ar.close()
+        self.assertEqual([k for k in uploads if k.startswith('metadata/')],
+                         ['metadata/snapshot-000000000001'])
+
+        # later runs only upload their changes
+        ar = archive.Archive()
+        ar.upload_one(filenames[1])
+        ar.close()
+        self.assertIn('metadata/segment-000000000002', uploads)
+        self.assertNotIn('metadata/snapshot-000000000002', uploads)
+
+        # and compact every few runs
+        with patch.object(archive.Archive, 'compact_segments', 2):
+            ar = archive.Archive()
+            ar.upload_one(filenames[2])
+            ar.close()
+        self.assertEqual([k for k in uploads if k.startswith('metadata/')],
+                         ['metadata/snapshot-000000000003'])
+
+        # a fresh machine starts from the snapshot
+        os.remove(ar.db_filename)
+        ar = archive.Archive()
+        try:
+            for filename in filenames:
+                self.assertTrue(ar.metadata.query('SELECT * FROM files WHERE path = ?', (filename,)))
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_metadata_sync_segments(self, s3_client):
+        uploads = self.fake_s3(s3_client)
+        ar = archive.Archive()
+        ar.close()
+        shutil.copy(ar.db_filename, 'metadata.sqlite.old')
+
+        # another machine uploads a file
+        filename = 'test'
+        with open(filename, 'wb') as f:
+            f.write(os.urandom(1000))
+        ar = archive.Archive()
+        ar.upload_one(filename)
+        ar.close()
+
+        # the first machine only downloads the new segment
+        shutil.copy('metadata.sqlite.old', ar.db_filename)
+        s3_client.return_value.download_fileobj.reset_mock()
+        ar = archive.Archive()
+        try:
+            keys = [c[1]['Key'] for c in s3_client.return_value.download_fileobj.call_args_list]
+            self.assertEqual(keys, ['metadata/segment-000000000001'])
+            self.assertTrue(ar.metadata.query('SELECT * FROM files WHERE path = ?', (filename,)))
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_metadata_sync_stopped(self, s3_client):
+        uploads = self.fake_s3(s3_client)
+        ar = archive.Archive()
+        ar.close()
+
+        # stops after uploading a segment, before clearing the sync log
+        filename = 'test'
+        with open(filename, 'wb') as f:
+            f.write(os.urandom(1000))
+        ar = archive.Archive()
+        ar.upload_one(filename)
+        write = ar.metadata.write
+        def stop(statements, log=True):
+            if statements[0][0].startswith('DELETE FROM sync_log'):
+                raise Exception('stopped')
+            write(statements, log)
+        with patch.object(ar.metadata, 'write', side_effect=stop):
+            with self.assertRaises(Exception):
+                ar.close()
+        ar.metadata.close()
+        self.assertIn('metadata/segment-000000000001', uploads)
+
+        # the segment is not applied again
+        ar = archive.Archive()
+        try:
+            ret = ar.metadata.query('SELECT refcount FROM chunks WHERE key = (SELECT sha256sum FROM files WHERE path = ?)', (filename,))
+            self.assertEqual(ret, [(1,)])
+            self.assertEqual(ar.metadata.get_state('last_segment'), 1)
+            self.assertIsNone(ar.metadata.get_state('uploading_segment'))
+            self.assertEqual(ar.metadata.query('SELECT count(*) FROM sync_log'), [(0,)])
+        finally:
+            ar.close()
+        self.assertNotIn('metadata/segment-000000000002', uploads)
+
+        # a segment that cannot be applied stops the open
+        uploads['metadata/segment-000000000002'] = util.Encrypt(self.encryption_token).encode(
+            json.dumps(['INSERT INTO nothing values (?)', [1]]).encode('utf-8')+b'\n')
+        with self.assertRaises(Exception):
+            archive.Archive()
+        m = metadata.Metadata(archive.Archive.db_filename)
+        try:
+            self.assertEqual(m.get_state('last_segment'), 1)
+        finally:
+            m.close()
+
     @patch('boto3.client', autospec=True)
     def test_upload_one(self, s3_client):
         e = util.Encrypt(self.encryption_token)
         s3_client.return_value.download_fileobj.side_effect = ClientError({},"download_fileobj")
+        uploads = self.fake_s3(s3_client)
         ar = archive.Archive()
         try:
             filename = 'test'
@@ -127,29 +883,739 @@ class TestArchive(unittest.TestCase):
                 f.write(data)
             ar.upload_one(filename)
             self.assertEqual(s3_client.return_value.upload_fileobj.call_count, 1)
-            data_enc = s3_client.return_value.upload_fileobj.call_args[1]['Fileobj'].getvalue()
+            data_enc = list(uploads.values())[-1]
             self.assertEqual(data, e.decode(data_enc))
         finally:
             ar.close()
 
+    @patch('boto3.client', autospec=True)
+    def test_upload_entry(self, s3_client):
+        uploads = self.fake_s3(s3_client)
+        ar = archive.Archive()
+        try:
+            with open('test', 'wb') as f:
+                f.write(os.urandom(1000))
+            os.symlink('test', 'link')
+            entries = [crawler.Entry.from_path(p) for p in ('test', 'link')]
+            # crawler entries are used without looking at the file metadata again
+            with patch('os.lstat', side_effect=OSError), patch('os.readlink', side_effect=OSError):
+                for e in entries:
+                    ar.upload_one(e)
+            ar.metadata.flush()
+            ret = ar.metadata.query('SELECT path, type, size FROM files ORDER BY path')
+            self.assertEqual(ret, [('link', 'link', 0), ('test', 'file', 1000)])
+        finally:
+            ar.close()
+
     @patch('boto3.client', autospec=True)
     def test_upload_one_large(self, s3_client):
         e = util.Encrypt(self.encryption_token)
         s3_client.return_value.download_fileobj.side_effect = ClientError({},"download_fileobj")
         s3_client.return_value.head_object.side_effect = ClientError({},"head_object")
+        uploads = self.fake_s3(s3_client)
         ar = archive.Archive()
         try:
             filename = 'test'
             data = os.urandom(25000)
             with open(filename, 'wb') as f:
                 f.write(data)
+            metrics.stats.reset()
             ar.upload_one(filename)
             self.assertEqual(s3_client.return_value.upload_fileobj.call_count, 3)
-            data_enc = [x[1]['Fileobj'].getvalue() for x in s3_client.return_value.upload_fileobj.call_args_list]
+            # the file reads and the hashing are timed on their own
+            self.assertEqual(metrics.stats.histograms['read'].bytes, 25000)
+            self.assertEqual(metrics.stats.histograms['hash'].bytes, 25000)
+            ar.metadata.flush()
+            ret = ar.metadata.query('SELECT chunk_checksums FROM files WHERE path = ?', (filename,))
+            data_enc = [uploads[k] for k in ret[0][0].split(',')]
             self.assertEqual(data, b''.join(e.decode(d) for d in data_enc))
         finally:
             ar.close()
 
+    @patch('boto3.client', autospec=True)
+    def test_upload_one_incremental(self, s3_client):
+        e = util.Encrypt(self.encryption_token)
+        s3_client.return_value.download_fileobj.side_effect = ClientError({},"download_fileobj")
+        uploads = self.fake_s3(s3_client)
+        ar = archive.Archive()
+        try:
+            filename = 'test'
+            with open(filename, 'wb') as f:
+                f.write(os.urandom(1000))
+            ar.upload_one(filename)
+            self.assertEqual(s3_client.return_value.upload_fileobj.call_count, 1)
+
+            # unchanged file is skipped without reading it
+            ar.metadata.flush()
+            with patch('builtins.open', wraps=open) as opened:
+                ar.upload_one(filename)
+                opened.assert_not_called()
+            self.assertEqual(s3_client.return_value.upload_fileobj.call_count, 1)
+
+            # changed file gets a new version
+            data = os.urandom(2000)
+            with open(filename, 'wb') as f:
+                f.write(data)
+            ar.upload_one(filename)
+            self.assertEqual(s3_client.return_value.upload_fileobj.call_count, 2)
+            data_enc = list(uploads.values())[-1]
+            self.assertEqual(data, e.decode(data_enc))
+            ar.metadata.flush()
+            ret = ar.metadata.query('SELECT size FROM files WHERE path = ?', (filename,))
+            self.assertEqual(ret, [(2000,)])
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_reload(self, s3_client):
+        s3_client.return_value.download_fileobj.side_effect = ClientError({},"download_fileobj")
+        ar = archive.Archive()
+        try:
+            with open('settings-test.json') as f:
+                settings = json.load(f)
+            def wait(done):
+                deadline = time.monotonic()+5
+                while not done() and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                self.assertTrue(done())
+
+            # a broken file is logged, and the old settings kept
+            with open('settings-test.json', 'w') as f:
+                f.write('{"read-bandwidth": ')
+            with self.assertLogs('archive', 'ERROR') as logs:
+                ar.reload()
+                wait(lambda: logs.records)
+            self.assertNotIn('read-bandwidth', ar.settings)
+            self.assertIsNone(ar.scheduler.limits['read'].rate)
+
+            settings['read-bandwidth'] = 1000
+            with open('settings-test.json', 'w') as f:
+                json.dump(settings, f)
+            ar.reload()
+            wait(lambda: ar.scheduler.limits['read'].rate == 1000)
+            self.assertEqual(ar.settings['read-bandwidth'], 1000)
+        finally:
+            ar.close()
+        self.assertFalse(ar.reloader.is_alive())
+
+    @patch('boto3.client', autospec=True)
+    def test_transfer_config(self, s3_client):
+        with open('settings-test.json') as f:
+            settings = json.load(f)
+        settings['s3-part-size'] = 16777216
+        settings['s3-max-bandwidth'] = 1000000
+        with open('settings-test.json', 'w') as f:
+            json.dump(settings, f)
+        s3_client.return_value.download_fileobj.side_effect = ClientError({},"download_fileobj")
+        ar = archive.Archive()
+        try:
+            filename = 'test'
+            with open(filename, 'wb') as f:
+                f.write(os.urandom(25000))
+            ar.upload_one(filename)
+            self.assertEqual(s3_client.return_value.upload_fileobj.call_count, 3)
+            for args in s3_client.return_value.upload_fileobj.call_args_list:
+                self.assertEqual(args[1]['Config'].multipart_chunksize, 16777216)
+                self.assertEqual(args[1]['Config'].max_bandwidth, 1000000)
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_s3_config(self, s3_client):
+        s3_client.return_value.download_fileobj.side_effect = ClientError({},"download_fileobj")
+        ar = archive.Archive()
+        try:
+            # 20 restore threads and 9 chunk, download, and bundle threads, each with 10 parts
+            config = s3_client.call_args[1]['config']
+            self.assertEqual(config.max_pool_connections, 290)
+        finally:
+            ar.close()
+
+        with open('settings-test.json') as f:
+            settings = json.load(f)
+        settings['s3-max-connections'] = 500
+        settings['s3-retry-mode'] = 'standard'
+        with open('settings-test.json', 'w') as f:
+            json.dump(settings, f)
+        s3_client.return_value.download_fileobj.side_effect = ClientError({},"download_fileobj")
+        ar = archive.Archive()
+        try:
+            config = s3_client.call_args[1]['config']
+            self.assertEqual(config.max_pool_connections, 500)
+            self.assertEqual(config.retries['mode'], 'standard')
+            self.assertEqual(config.retries['max_attempts'], 10)
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_compression_level(self, s3_client):
+        with open('settings-test.json') as f:
+            settings = json.load(f)
+        settings['compression-extensions'] = {'.jpg': 0}
+        settings['compression-paths'] = {'/data': 1, '/data/text': 19}
+        with open('settings-test.json', 'w') as f:
+            json.dump(settings, f)
+        s3_client.return_value.download_fileobj.side_effect = ClientError({},"download_fileobj")
+        ar = archive.Archive()
+        try:
+            self.assertEqual(ar.compression_level('/data/text/a.txt'), 19)
+            self.assertEqual(ar.compression_level('/data/a.jpg'), 1)
+            self.assertEqual(ar.compression_level('/database/a.jpg'), 0)
+            self.assertEqual(ar.compression_level('/home/a.JPG'), 0)
+            self.assertIsNone(ar.compression_level('/home/a.txt'))
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_upload_dedup(self, s3_client):
+        s3_client.return_value.download_fileobj.side_effect = ClientError({},"download_fileobj")
+        ar = archive.Archive()
+        try:
+            data = os.urandom(25000)
+            for filename in ('test1', 'test2'):
+                with open(filename, 'wb') as f:
+                    f.write(data)
+                ar.upload_one(filename)
+                ar.metadata.flush()
+            self.assertEqual(s3_client.return_value.upload_fileobj.call_count, 3)
+            s3_client.return_value.head_object.assert_not_called()
+            ar.metadata.flush()
+            ret = ar.metadata.query('SELECT refcount FROM chunks')
+            self.assertEqual(ret, [(2,),(2,),(2,)])
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_upload_cdc(self, s3_client):
+        with open('settings-test.json') as f:
+            settings = json.load(f)
+        settings.update({'chunking': 'cdc', 'chunk-min-size': 2000, 'chunk-avg-size': 8000, 'chunk-max-size': 20000})
+        with open('settings-test.json', 'w') as f:
+            json.dump(settings, f)
+        uploads = self.fake_s3(s3_client)
+        ar = archive.Archive()
+        try:
+            filename = 'test'
+            data = random.Random(42).randbytes(400000)
+            with open(filename, 'wb') as f:
+                f.write(data)
+            ar.upload_one(filename)
+            ar.metadata.flush()
+            chunks = len(uploads)
+            self.assertGreater(chunks, 10)
+
+            # after an insert, only the new chunks are encoded
+            with open(filename, 'wb') as f:
+                f.write(data[:200000]+b'x'+data[200000:])
+            with patch.object(ar.encrypt, 'encode_stream', wraps=ar.encrypt.encode_stream) as encode_stream:
+                ar.upload_one(filename)
+            self.assertLessEqual(len(uploads)-chunks, 2)
+            self.assertEqual(encode_stream.call_count, len(uploads)-chunks)
+            ar.metadata.flush()
+            output = os.path.join(self.destdir, 'test')
+            ar.restore_one(filename, output)
+            with open(output, 'rb') as f:
+                self.assertEqual(f.read(), data[:200000]+b'x'+data[200000:])
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_rebuild_chunk_index(self, s3_client):
+        s3_client.return_value.download_fileobj.side_effect = ClientError({},"download_fileobj")
+        with sqlite3.connect(archive.Archive.db_filename) as db:
+            db.execute('CREATE TABLE files (path, size, type, date_modified, link_path, sha256sum, chunk_checksums)')
+            db.execute('INSERT INTO files values ("test",25000,"file","","","abc","a,b")')
+        paginate = s3_client.return_value.get_paginator.return_value.paginate
+        paginate.return_value = [
+            {'Contents': [{'Key': 'a', 'Size': 100}, {'Key': 'metadata.sqlite', 'Size': 10}]},
+            {'Contents': [{'Key': 'b', 'Size': 200}, {'Key': 'c', 'Size': 300}]},
+        ]
+        ar = archive.Archive()
+        try:
+            s3_client.return_value.get_paginator.assert_called_with('list_objects_v2')
+            ar.metadata.flush()
+            ret = ar.metadata.query('SELECT key, size, refcount FROM chunks ORDER BY key')
+            self.assertEqual(ret, [('a',100,1), ('b',200,1), ('c',300,0)])
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_upload_bundle(self, s3_client):
+        archive.Archive.bundle_file_size = 2000
+        s3_client.return_value.download_fileobj.side_effect = ClientError({},"download_fileobj")
+        uploads = self.fake_s3(s3_client)
+        ar = archive.Archive()
+        try:
+            data = {}
+            for i in range(10):
+                filename = os.path.join(self.srcdir, 'test%d'%i)
+                data[filename] = os.urandom(1000)
+                with open(filename, 'wb') as f:
+                    f.write(data[filename])
+            ar.upload_many(self.srcdir)
+            self.assertEqual(s3_client.return_value.upload_fileobj.call_count, 1)
+            key = s3_client.return_value.upload_fileobj.call_args[1]['Key']
+            self.assertTrue(key.startswith('bundles/'))
+
+            # restore a single file with a ranged get
+            filename = os.path.join(self.srcdir, 'test3')
+            output = os.path.join(self.destdir, 'test3')
+            ar.restore_one(filename, output)
+            with open(output, 'rb') as f:
+                self.assertEqual(f.read(), data[filename])
+            self.assertEqual(s3_client.return_value.get_object.call_args[1]['Key'], key)
+            s3_client.return_value.download_fileobj.assert_called_once()
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_upload_bundle_grown(self, s3_client):
+        archive.Archive.bundle_file_size = 2000
+        uploads = self.fake_s3(s3_client)
+        ar = archive.Archive()
+        try:
+            filename = 'test'
+            with open(filename, 'wb') as f:
+                f.write(os.urandom(1000))
+            entry = crawler.Entry.from_path(filename)
+            # grows between the crawl and the read
+            data = os.urandom(25000)
+            with open(filename, 'wb') as f:
+                f.write(data)
+            ar.upload_one(entry)
+            self.assertEqual(s3_client.return_value.upload_fileobj.call_count, 3)
+            self.assertFalse([k for k in uploads if k.startswith('bundles/')])
+            ar.metadata.flush()
+            ret = ar.metadata.query('SELECT size FROM files WHERE path = ?', (filename,))
+            self.assertEqual(ret, [(25000,)])
+            output = os.path.join(self.destdir, 'test')
+            ar.restore_one(filename, output)
+            with open(output, 'rb') as f:
+                self.assertEqual(f.read(), data)
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_restore_many(self, s3_client):
+        archive.Archive.bundle_file_size = 2000
+        self.fake_s3(s3_client)
+        ar = archive.Archive()
+        try:
+            self.make_dirs(self.srcdir, N=12, M=20000)
+            os.symlink('foo', os.path.join(self.srcdir, 'link'))
+            with open(os.path.join(self.srcdir, 'large'), 'wb') as f:
+                f.write(os.urandom(35000))
+            ar.upload_many(self.srcdir)
+            output = os.path.join(self.destdir, 'src')
+            ar.restore_many(self.srcdir, output)
+            for root, dirs, files in os.walk(self.srcdir):
+                for name in files:
+                    src = os.path.join(root, name)
+                    dest = output+src[len(self.srcdir):]
+                    if os.path.islink(src):
+                        self.assertEqual(os.readlink(dest), os.path.join(self.srcdir, 'foo'))
+                        continue
+                    with open(src, 'rb') as f1, open(dest, 'rb') as f2:
+                        self.assertEqual(f1.read(), f2.read())
+                    self.assertAlmostEqual(os.path.getmtime(src), os.path.getmtime(dest), places=5)
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_upload_removed(self, s3_client):
+        self.fake_s3(s3_client)
+        ar = archive.Archive()
+        try:
+            for i in range(10):
+                with open(os.path.join(self.srcdir, 'test%d' % i), 'wb') as f:
+                    f.write(os.urandom(1000))
+            gone = os.path.join(self.srcdir, 'test3')
+            # removed after it was crawled, before it is read
+            def upload_content(entry, upload_content=ar.upload_content):
+                if entry.path == gone:
+                    os.remove(gone)
+                upload_content(entry)
+            with patch.object(ar, 'upload_content', side_effect=upload_content):
+                with self.assertLogs('archive', 'ERROR'):
+                    ar.upload_many(self.srcdir)
+            ar.metadata.flush()
+            paths = [p for p, in ar.metadata.query('SELECT path FROM files')]
+            self.assertEqual(len(paths), 9)
+            self.assertNotIn(gone, paths)
+            self.assertEqual(ar.metadata.query('SELECT count(*) FROM upload_files'), [(0,)])
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_upload_interrupted(self, s3_client):
+        self.fake_s3(s3_client)
+        ar = archive.Archive()
+        try:
+            for i in range(40):
+                with open(os.path.join(self.srcdir, 'test%d' % i), 'wb') as f:
+                    f.write(os.urandom(100))
+            release = threading.Event()
+            started = []
+            def upload_content(entry):
+                started.append(entry.path)
+                release.wait()
+            def journal_entries(job, journal_entries=ar.journal_entries):
+                for n, entry in enumerate(journal_entries(job)):
+                    if n == 30:
+                        # stopped with the first files still uploading
+                        release.set()
+                        raise KeyboardInterrupt()
+                    yield entry
+            with patch.object(ar, 'upload_content', side_effect=upload_content), \
+                 patch.object(ar, 'journal_entries', side_effect=journal_entries):
+                with self.assertRaises(KeyboardInterrupt):
+                    ar.upload_many(self.srcdir)
+            # the queued files are left for the next run
+            self.assertLessEqual(len(started), 20)
+            self.assertEqual(ar.metadata.query('SELECT count(*) FROM upload_jobs'), [(1,)])
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_upload_resume(self, s3_client):
+        uploads = self.fake_s3(s3_client)
+        upload_fileobj = s3_client.return_value.upload_fileobj.side_effect
+        files = {}
+        for d in ('a', 'b', 'c'):
+            os.mkdir(os.path.join(self.srcdir, d))
+            for i in range(3):
+                files[os.path.join(self.srcdir, d, str(i))] = os.urandom(1000)
+        big = os.path.join(self.srcdir, 'big')
+        files[big] = os.urandom(50000)
+        for name, data in files.items():
+            with open(name, 'wb') as f:
+                f.write(data)
+
+        # stop the run at the fourth chunk of the big file
+        stop = hashlib.sha512(files[big][30000:40000]).hexdigest()
+        def fail_upload(Fileobj, Bucket, Key, **kwargs):
+            if Key == stop:
+                raise Exception('stopped')
+            upload_fileobj(Fileobj, Bucket, Key, **kwargs)
+        s3_client.return_value.upload_fileobj.side_effect = fail_upload
+        ar = archive.Archive()
+        try:
+            with self.assertRaises(Exception):
+                ar.upload_many(self.srcdir)
+        finally:
+            ar.close()
+        s3_client.return_value.upload_fileobj.side_effect = upload_fileobj
+
+        ar = archive.Archive()
+        try:
+            dirs = [d for d, in ar.metadata.query('SELECT path FROM upload_dirs')]
+            self.assertEqual(ar.metadata.query('SELECT n FROM upload_chunks WHERE path = ? AND n < 3', (big,)), [(0,), (1,), (2,)])
+            encoded = collections.Counter()
+            def read_chunks(f, *args, read_chunks=util.read_chunks):
+                for ret in read_chunks(f, *args):
+                    encoded[f.name] += 1
+                    yield ret
+            with patch.object(util, 'read_chunks', read_chunks), \
+                 patch.object(crawler, 'crawl', wraps=crawler.crawl) as crawl:
+                ar.upload_many(self.srcdir)
+            # only the rest of the big file is encoded, and only the
+            # directories that were not crawled are crawled
+            self.assertEqual(encoded[big], 2)
+            self.assertEqual(crawl.call_count, 1 if dirs else 0)
+            if dirs:
+                self.assertEqual(sorted(crawl.call_args[0][0]), sorted(dirs))
+            self.assertEqual(len(ar.list_snapshots()), 1)
+            for table in ('upload_jobs', 'upload_dirs', 'upload_files', 'upload_chunks'):
+                self.assertEqual(ar.metadata.query('SELECT count(*) FROM '+table)[0][0], 0)
+
+            output = os.path.join(self.destdir, 'src')
+            ar.restore_many(self.srcdir, output)
+            for name, data in files.items():
+                with open(os.path.join(output, os.path.relpath(name, self.srcdir)), 'rb') as f:
+                    self.assertEqual(f.read(), data)
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_upload_hardlinks(self, s3_client):
+        uploads = self.fake_s3(s3_client)
+        ar = archive.Archive()
+        try:
+            data = os.urandom(25000)
+            names = [os.path.join(self.srcdir, n) for n in ('a', 'b', 'c', 'copy')]
+            with open(names[0], 'wb') as f:
+                f.write(data)
+            os.link(names[0], names[1])
+            os.link(names[0], names[2])
+            with open(names[3], 'wb') as f:
+                f.write(data)
+            with patch.object(ar, 'encode_file', wraps=ar.encode_file) as encode_file:
+                ar.upload_many(self.srcdir)
+            # the links are read once, and each chunk is uploaded once
+            self.assertEqual(encode_file.call_count, 2)
+            self.assertEqual(s3_client.return_value.upload_fileobj.call_count, 3)
+            rows = dict(ar.metadata.query('SELECT path, link_path FROM files'))
+            self.assertEqual(sorted(rows[n] for n in names[:3]).count(''), 1)
+            self.assertEqual(rows[names[3]], '')
+
+            output = os.path.join(self.destdir, 'src')
+            ar.restore_many(self.srcdir, output)
+            inodes = [os.stat(os.path.join(output, os.path.basename(n))).st_ino for n in names]
+            self.assertEqual(len(set(inodes[:3])), 1)
+            self.assertNotEqual(inodes[0], inodes[3])
+            with open(os.path.join(output, 'b'), 'rb') as f:
+                self.assertEqual(f.read(), data)
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_upload_hardlinks_bundled(self, s3_client):
+        archive.Archive.bundle_file_size = 2000
+        uploads = self.fake_s3(s3_client)
+        ar = archive.Archive()
+        try:
+            data = os.urandom(1000)
+            names = [os.path.join(self.srcdir, n) for n in ('a', 'b', 'c')]
+            with open(names[0], 'wb') as f:
+                f.write(data)
+            os.link(names[0], names[1])
+            os.link(names[0], names[2])
+            ar.upload_many(self.srcdir)
+            self.assertEqual(s3_client.return_value.upload_fileobj.call_count, 1)
+            # the encoded data is not kept for the other links
+            for fut in ar.hardlinks.stored.values():
+                self.assertFalse([v for v in fut.result() if isinstance(v, bytes)])
+            ar.metadata.flush()
+            rows = dict(ar.metadata.query('SELECT path, link_path FROM files'))
+            self.assertEqual(sorted(rows), names)
+
+            output = os.path.join(self.destdir, 'src')
+            ar.restore_many(self.srcdir, output)
+            with open(os.path.join(output, 'c'), 'rb') as f:
+                self.assertEqual(f.read(), data)
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_snapshots(self, s3_client):
+        archive.Archive.bundle_file_size = 2000
+        self.fake_s3(s3_client)
+        ar = archive.Archive()
+        try:
+            a, b, c = (os.path.join(self.srcdir, n) for n in 'abc')
+            old = os.urandom(1000)
+            for filename in (a, b):
+                with open(filename, 'wb') as f:
+                    f.write(old)
+            ar.upload_many(self.srcdir)
+
+            # the next run changes a, deletes b, and adds c
+            ar.snapshot_id = None
+            new = os.urandom(1500)
+            for filename in (a, c):
+                with open(filename, 'wb') as f:
+                    f.write(new)
+            os.remove(b)
+            ar.upload_many(self.srcdir)
+            self.assertEqual([s for s, d in ar.list_snapshots()], [1, 2])
+            self.assertEqual(list(ar.diff_snapshots(1, 2)), [('modified', a), ('deleted', b), ('added', c)])
+            self.assertEqual(ar.find_snapshot('1'), 1)
+            self.assertEqual(ar.find_snapshot('2100-01-01'), 2)
+            with self.assertRaises(Exception):
+                ar.find_snapshot('2000-01-01T00:00:00+00:00')
+
+            output = os.path.join(self.destdir, 'old')
+            ar.restore_many(self.srcdir, output, 1)
+            self.assertEqual(sorted(os.listdir(output)), ['a', 'b'])
+            with open(os.path.join(output, 'a'), 'rb') as f:
+                self.assertEqual(f.read(), old)
+            output = os.path.join(self.destdir, 'new')
+            ar.restore_many(self.srcdir, output)
+            self.assertEqual(sorted(os.listdir(output)), ['a', 'c'])
+            with open(os.path.join(output, 'a'), 'rb') as f:
+                self.assertEqual(f.read(), new)
+            with self.assertRaises(Exception):
+                ar.restore_one(b, os.path.join(output, 'b'))
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_tree(self, s3_client):
+        archive.Archive.bundle_file_size = 2000
+        self.fake_s3(s3_client)
+        ar = archive.Archive()
+        try:
+            sub = os.path.join(self.srcdir, 'sub')
+            os.makedirs(os.path.join(sub, 'deeper'))
+            for filename, size in (('a', 100), ('sub/b', 200), ('sub/deeper/c', 300)):
+                with open(os.path.join(self.srcdir, filename), 'wb') as f:
+                    f.write(os.urandom(size))
+            # a sibling that sorts between the subtree bounds of sub with LIKE
+            with open(sub+'-x', 'wb') as f:
+                f.write(os.urandom(400))
+            ar.upload_many(self.srcdir)
+
+            ret = list(ar.list_dir(self.srcdir))
+            self.assertEqual([(p, t) for p, t, s, d in ret],
+                             [(sub, 'directory'), (os.path.join(self.srcdir, 'a'), 'file'), (sub+'-x', 'file')])
+            ret = list(ar.list_dir(sub+'/'))
+            self.assertEqual([(p, t, s) for p, t, s, d in ret],
+                             [(os.path.join(sub, 'deeper'), 'directory', None), (os.path.join(sub, 'b'), 'file', 200)])
+            self.assertEqual(ar.du(sub), (2, 500))
+            self.assertEqual(ar.du(self.srcdir), (4, 1000))
+
+            output = os.path.join(self.destdir, 'sub')
+            ar.restore_many(sub, output)
+            self.assertEqual(sorted(os.listdir(output)), ['b', 'deeper'])
+            with self.assertRaises(Exception):
+                ar.restore_many(sub+'-', output)
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_restore_range(self, s3_client):
+        archive.Archive.bundle_file_size = 2000
+        self.fake_s3(s3_client)
+        ar = archive.Archive()
+        try:
+            large = os.path.join(self.srcdir, 'large')
+            small = os.path.join(self.srcdir, 'small')
+            data = os.urandom(35000)
+            with open(large, 'wb') as f:
+                f.write(data)
+            with open(small, 'wb') as f:
+                f.write(data[:1000])
+            ar.upload_many(self.srcdir)
+
+            output = os.path.join(self.destdir, 'out')
+            s3_client.return_value.get_object.reset_mock()
+            ar.restore_range(large, output, 9000, 3000)
+            with open(output, 'rb') as f:
+                self.assertEqual(f.read(), data[9000:12000])
+            # only the two chunks holding the range
+            self.assertEqual(s3_client.return_value.get_object.call_count, 2)
+            ar.restore_range(large, output, 34000, 5000)
+            with open(output, 'rb') as f:
+                self.assertEqual(f.read(), data[34000:])
+            ar.restore_range(small, output, 10, 20)
+            with open(output, 'rb') as f:
+                self.assertEqual(f.read(), data[10:30])
+
+            with ar.open(large) as f:
+                self.assertEqual(f.read(100), data[:100])
+                f.seek(25000)
+                self.assertEqual(f.read(), data[25000:])
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_restore_cache(self, s3_client):
+        self.fake_s3(s3_client)
+        ar = archive.Archive()
+        try:
+            filename = os.path.join(self.srcdir, 'test')
+            data = os.urandom(25000)
+            with open(filename, 'wb') as f:
+                f.write(data)
+            ar.upload_one(filename)
+            ar.metadata.flush()
+            for i in range(2):
+                s3_client.return_value.download_fileobj.reset_mock()
+                output = os.path.join(self.destdir, 'test%d' % i)
+                with patch.object(ar.chunk_cache, 'copy', wraps=ar.chunk_cache.copy) as copy:
+                    ar.restore_one(filename, output)
+                # chunks are written to the cache and the output in one pass,
+                # not copied out of the cache after a miss
+                self.assertEqual(copy.call_count, 3)
+                with open(output, 'rb') as f:
+                    self.assertEqual(f.read(), data)
+            # the second restore only reads the cache
+            s3_client.return_value.download_fileobj.assert_not_called()
+            self.assertEqual(ar.chunk_cache.stats['hits'], 3)
+            self.assertEqual(ar.chunk_cache.stats['misses'], 3)
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_verify(self, s3_client):
+        archive.Archive.bundle_file_size = 2000
+        uploads = self.fake_s3(s3_client)
+        ar = archive.Archive()
+        try:
+            for name, size in (('big', 250000), ('small1', 1000), ('small2', 2000)):
+                with open(os.path.join(self.srcdir, name), 'wb') as f:
+                    f.write(os.urandom(size))
+            ar.upload_many(self.srcdir)
+            ar.bundler.flush()
+            ar.metadata.flush()
+            self.assertEqual(list(ar.verify_listing()), [])
+            self.assertEqual(list(ar.verify_objects()), [])
+
+            chunks = sorted(k for k in uploads if len(k) == 128)
+            del uploads[chunks[0]]
+            uploads[chunks[1]] = uploads[chunks[1]][:-1]
+            uploads['0'*128] = b'orphan'
+            problems = set(ar.verify_listing())
+            self.assertEqual(problems, {('missing', chunks[0]), ('size', chunks[1]), ('orphaned', '0'*128)})
+
+            problems = set(ar.verify_objects(bandwidth=10**9))
+            self.assertEqual(problems, {('missing', chunks[0]), ('corrupt', chunks[1])})
+
+            # a stopped deep verify continues where it stopped
+            keys = sorted(k for k, in ar.metadata.query('SELECT key FROM chunks'))
+            checked = []
+            stop = [keys[1]]
+            def verify_object(key, verify_object=ar.verify_object):
+                if key in stop:
+                    stop.clear()
+                    raise Exception('stop')
+                checked.append(key)
+                return verify_object(key)
+            with patch.object(ar, 'verify_object', side_effect=verify_object):
+                with self.assertRaises(Exception):
+                    list(ar.verify_objects())
+                ar.metadata.flush()
+                self.assertEqual(ar.metadata.get_state('verify_position'), keys[0])
+                checked = []
+                list(ar.verify_objects())
+            self.assertEqual(sorted(checked), keys[1:])
+            ar.metadata.flush()
+            self.assertIsNone(ar.metadata.get_state('verify_position'))
+        finally:
+            ar.close()
+
+    @patch('boto3.client', autospec=True)
+    def test_upload_lanes(self, s3_client):
+        self.fake_s3(s3_client)
+        self.addCleanup(setattr, archive.Archive, 'large_file_size', archive.Archive.large_file_size)
+        archive.Archive.large_file_size = 20000
+        ar = archive.Archive()
+        try:
+            s3_client.return_value.meta.events.register.assert_called_with('before-call.s3', ar._request_limit)
+            big = os.path.join(self.srcdir, 'big')
+            with open(big, 'wb') as f:
+                f.write(os.urandom(50000))
+            for i in range(10):
+                with open(os.path.join(self.srcdir, 'small%d' % i), 'wb') as f:
+                    f.write(os.urandom(1000))
+            # the small files finish while the big file is stuck
+            small_done = []
+            def upload_content(entry, upload_content=ar.upload_content):
+                if entry.path == big:
+                    for _ in range(100):
+                        ar.metadata.flush()
+                        if ar.metadata.query('SELECT count(*) FROM files')[0][0] == 10:
+                            small_done.append(True)
+                            break
+                        time.sleep(.05)
+                upload_content(entry)
+            with patch.object(ar, 'upload_content', side_effect=upload_content):
+                ar.upload_many(self.srcdir)
+            self.assertEqual(small_done, [True])
+            self.assertEqual(ar.metadata.query('SELECT count(*) FROM files')[0][0], 11)
+        finally:
+            ar.close()
+
     @patch('boto3.client', autospec=True)
     def test_upload_two(self, s3_client):
         e = util.Encrypt(self.encryption_token)
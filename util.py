@@ -1,35 +1,572 @@
 import os
+import io
 import base64
+import collections
 import json
 import hashlib
-from datetime import datetime
+import struct
+import tempfile
+import time
+import threading
+import multiprocessing
+import concurrent.futures
+from datetime import datetime, timezone
 import logging
 
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 import zstd
 
+import metrics
+
 logger = logging.getLogger('util')
 
+SPOOL_SIZE = 16777216 # 16 MB
+
+# Object format, version 3:
+#   header: MAGIC, version byte, 32 byte random salt
+#   frames: flags byte, 4 byte length, AES-GCM(zstd(plaintext))
+# Each frame holds at most `Encrypt.frame_size` bytes of plaintext.
+# Frames with the FRAME_RAW flag hold the plaintext uncompressed.
+# Each object is encrypted with its own key, derived from the frame key
+# and the salt, so nonces only need to be unique within an object: the
+# frame nonce is the frame counter.  The header, flags, and counter are
+# authenticated so frames cannot be reordered or truncated.
+# Objects without the magic are in the original Fernet format.
+MAGIC = b'S3A'
+VERSION = 3
+SALT_SIZE = 32
+NONCE_PREFIX = bytes(8) # before the frame counter
+FRAME_LAST = 1
+FRAME_RAW = 2
+FRAME_HEADER = struct.Struct('>BI')
+
+SAMPLE_SIZE = 16384 # bytes from each of 3 places in a frame
+INCOMPRESSIBLE = 0.95 # sample compression ratio to give up on a frame
+
+class OffsetWriter:
+    """
+    A file-like writer for one region of a file.
+
+    Writes go to the file descriptor with `os.pwrite`, starting at
+    `offset`, so several regions of a file can be written at once.
+
+    Args:
+        fd (int): an open file descriptor
+        offset (int): where to start writing
+    """
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data):
+        data = memoryview(data)
+        ret = len(data)
+        while data:
+            n = os.pwrite(self.fd, data, self.offset)
+            self.offset += n
+            data = data[n:]
+        return ret
+
+class ContentCache:
+    """
+    Content stored, or being stored, during this run.
+
+    The first worker to claim a key stores it and resolves the Future;
+    other workers wait on that Future instead of storing it again.
+    Keys being stored are always kept.  Stored keys are kept in an LRU
+    of `size` keys, after which the metadata database has them.  Keys
+    that fail are dropped, so a later claim tries again.
+
+    Args:
+        size (int): the number of stored keys to keep
+    """
+    def __init__(self, size=100000):
+        self.size = size
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.stored = collections.OrderedDict()
+
+    def _get(self, key):
+        fut = self.pending.get(key)
+        if fut is None:
+            fut = self.stored.get(key)
+            if fut is not None:
+                self.stored.move_to_end(key)
+        return fut
+
+    def get(self, key):
+        """Get the Future for a key, or None if it was not claimed in this run"""
+        with self.lock:
+            return self._get(key)
+
+    def claim(self, key):
+        """
+        Claim a key to store.
+
+        Returns:
+            tuple: (Future, True) if the caller must store the key and
+                   resolve the Future, otherwise (Future, False)
+        """
+        with self.lock:
+            fut = self._get(key)
+            if fut is not None:
+                return fut, False
+            fut = self.pending[key] = concurrent.futures.Future()
+        fut.add_done_callback(lambda f: self._done(key, f))
+        return fut, True
+
+    def _done(self, key, fut):
+        with self.lock:
+            del self.pending[key]
+            if fut.exception() is None:
+                self.stored[key] = fut
+                while len(self.stored) > self.size:
+                    self.stored.popitem(last=False)
+
+class HashWriter:
+    """
+    A file-like writer that only hashes what is written to it.
+
+    Args:
+        hasher (hashlib object): (optional) the hash, sha512 by default
+    """
+    def __init__(self, hasher=None):
+        self.hash = hasher or hashlib.sha512()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+class TeeWriter:
+    """
+    A file-like writer that writes to two files in one pass.
+
+    Args:
+        fileobj (file): gets everything written
+        other (file): gets what is written after the first `skip` bytes
+        skip (int): (optional) the bytes to leave out of `other`
+    """
+    def __init__(self, fileobj, other, skip=0):
+        self.fileobj = fileobj
+        self.other = other
+        self.skip = skip
+
+    def write(self, data):
+        self.fileobj.write(data)
+        ret = len(data)
+        if self.skip >= ret:
+            self.skip -= ret
+            return ret
+        if self.skip:
+            data = memoryview(data)[self.skip:]
+            self.skip = 0
+        self.other.write(data)
+        return ret
+
+class TokenBucket:
+    """
+    Limit a rate, such as bytes/s.
+
+    `take` waits until there are enough tokens.  A take larger than
+    the bucket goes into debt, which later takes wait out.
+
+    Args:
+        rate (float): tokens added per second, or None for no limit
+        burst (float): (optional) the most tokens to save up, one second's worth by default
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate, burst=None):
+        """Change the rate, keeping the tokens (or debt) saved up so far"""
+        with self.lock:
+            now = time.monotonic()
+            if rate and self.rate:
+                self.tokens = min(self.burst, self.tokens + (now-self.last)*self.rate, burst or rate)
+            else:
+                self.tokens = burst or rate
+            self.rate = rate
+            self.burst = burst or rate
+            self.last = now
+
+    def take(self, n):
+        """Wait until `n` tokens are available, then use them"""
+        with self.lock:
+            if not self.rate:
+                return
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now-self.last)*self.rate) - n
+            self.last = now
+            wait = -self.tokens/self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+class LimitedReader:
+    """
+    A file-like reader that takes each read from a TokenBucket.
+
+    Each read is timed as the `read` stage, not counting the time
+    waiting on the bucket.
+
+    Args:
+        fileobj (file): the file to read
+        bucket (TokenBucket): the read limit, in bytes/s
+    """
+    def __init__(self, fileobj, bucket):
+        self.fileobj = fileobj
+        self.bucket = bucket
+
+    def read(self, size=-1):
+        start = time.monotonic()
+        data = self.fileobj.read(size)
+        metrics.observe('read', time.monotonic()-start, len(data))
+        self.bucket.take(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+def spool():
+    """Get a temporary file that stays in memory until it gets large"""
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+def read_exact(f, size):
+    """Read exactly `size` bytes from a file object"""
+    ret = f.read(size)
+    while len(ret) < size:
+        data = f.read(size-len(ret))
+        if not data:
+            raise Exception('truncated object')
+        ret += data
+    return ret
+
+class AutoLevel:
+    """
+    Pick the compression level to keep compression near a target speed.
+
+    The level drops when compression is slower than the target, and
+    rises (up to `max_level`) when it is more than twice as fast.
+
+    Args:
+        max_level (int): the highest level to use
+        target (float): the target speed, in bytes/s
+    """
+    def __init__(self, max_level, target):
+        self.max_level = max_level
+        self.target = target
+        self.level = max_level
+        self.lock = threading.Lock()
+
+    def update(self, size, seconds):
+        """Record compressing `size` bytes in `seconds`"""
+        speed = size / max(seconds, 1e-9)
+        with self.lock:
+            if speed < self.target and self.level > 1:
+                self.level -= 1
+            elif speed > self.target*2 and self.level < self.max_level:
+                self.level += 1
+
+def compressible(data):
+    """Check if data is worth compressing, using a fast compression of a sample"""
+    if len(data) <= SAMPLE_SIZE*3:
+        sample = data
+    else:
+        mid = len(data)//2
+        sample = data[:SAMPLE_SIZE] + data[mid:mid+SAMPLE_SIZE] + data[-SAMPLE_SIZE:]
+    return len(zstd.compress(sample, 1)) < len(sample)*INCOMPRESSIBLE
+
+def object_cipher(key, salt):
+    """Get the cipher of one object, from the frame key and the object's salt"""
+    return AESGCM(HKDF(algorithm=hashes.SHA256(), length=32, salt=salt,
+                       info=b's3_archive object').derive(key))
+
+def encode_frame(aead, header, counter, flags, data, level):
+    """
+    Compress and encrypt one frame.
+
+    Args:
+        aead (AESGCM): the object cipher
+        header (bytes): the object header
+        counter (int): the frame number
+        flags (int): frame flags
+        data (bytes): the frame plaintext
+        level (int): zstd compression level
+
+    Returns:
+        tuple: (flags, encrypted frame, seconds spent compressing)
+    """
+    seconds = 0
+    if level <= 0 or not data or not compressible(data):
+        flags |= FRAME_RAW
+    else:
+        start = time.monotonic()
+        d = zstd.compress(data, level)
+        seconds = time.monotonic()-start
+        if len(d) < len(data):
+            data = d
+        else:
+            flags |= FRAME_RAW
+    nonce = NONCE_PREFIX + struct.pack('>I', counter)
+    aad = header + struct.pack('>BI', flags, counter)
+    return flags, aead.encrypt(nonce, data, aad), seconds
+
+# the frame key of a pool process
+_pool_key = None
+
+def _init_pool(key):
+    global _pool_key
+    _pool_key = Encrypt(key).frame_key
+
+def _pool_encode_frame(header, counter, flags, data, level):
+    aead = object_cipher(_pool_key, header[-SALT_SIZE:])
+    return encode_frame(aead, header, counter, flags, data, level)
+
+class Encoder:
+    """
+    Incrementally compress and encrypt data into a file object.
+
+    Frames that do not compress are stored raw.  A level of 0 stores
+    every frame raw.
+
+    With a process pool, frames are encoded in the pool, and written in
+    order as they finish.  The `slots` semaphore bounds the number of
+    frames in the pool or waiting to be written, across all encoders
+    sharing it.  Frames under `pool_min` bytes, such as the whole of a
+    small file, are encoded inline, since sending them to the pool costs
+    more than encoding them.
+
+    Args:
+        key (bytes): the frame key, which the object key is derived from
+        fileobj (file): file object to write the encoded object to
+        level (int): zstd compression level
+        frame_size (int): plaintext bytes per frame
+        auto (AutoLevel): (optional) pick the level automatically instead
+        pool (ProcessPoolExecutor): (optional) a pool to encode frames in
+        slots (BoundedSemaphore): (optional) the free slots in the pool
+    """
+    pool_min = 1048576 # 1 MB
+
+    def __init__(self, key, fileobj, level, frame_size, auto=None, pool=None, slots=None):
+        salt = os.urandom(SALT_SIZE)
+        self.aead = object_cipher(key, salt)
+        self.fileobj = fileobj
+        self.level = level
+        self.frame_size = frame_size
+        self.auto = auto
+        self.pool = pool
+        self.slots = slots
+        self.pending = collections.deque()
+        self.header = MAGIC + bytes([VERSION]) + salt
+        self.counter = 0
+        self.buf = bytearray()
+        self.fileobj.write(self.header)
+
+    def _write(self, size, flags, d, seconds):
+        if self.auto and seconds:
+            self.auto.update(size, seconds)
+        if flags & FRAME_RAW:
+            metrics.add('raw_frames')
+        else:
+            metrics.observe('compress', seconds, size)
+        self.fileobj.write(FRAME_HEADER.pack(flags, len(d)))
+        self.fileobj.write(d)
+
+    def _write_next(self):
+        size, fut = self.pending.popleft()
+        try:
+            self._write(size, *fut.result())
+        finally:
+            self.slots.release()
+
+    def _frame(self, data, flags):
+        level = self.auto.level if self.auto else self.level
+        if self.pool and len(data) >= self.pool_min:
+            # wait for a slot, writing out our own frames to free one
+            while not self.slots.acquire(blocking=False):
+                if self.pending:
+                    self._write_next()
+                else:
+                    self.slots.acquire()
+                    break
+            try:
+                fut = self.pool.submit(_pool_encode_frame, self.header, self.counter, flags, data, level)
+            except Exception:
+                self.slots.release()
+                raise
+            self.pending.append((len(data), fut))
+            # write out the frames that are done, in order
+            while self.pending and (self.pending[0][1].done() or flags & FRAME_LAST):
+                self._write_next()
+        else:
+            # the frames before this one go first
+            while self.pending:
+                self._write_next()
+            self._write(len(data), *encode_frame(self.aead, self.header, self.counter, flags, data, level))
+        self.counter += 1
+
+    def write(self, data):
+        self.buf += data
+        # always keep some data back for the last frame
+        while len(self.buf) > self.frame_size:
+            self._frame(bytes(self.buf[:self.frame_size]), 0)
+            del self.buf[:self.frame_size]
+
+    def close(self):
+        self._frame(bytes(self.buf), FRAME_LAST)
+        self.buf = bytearray()
+
+    def abort(self):
+        """Give up on the object, dropping any frames still in the pool"""
+        while self.pending:
+            size, fut = self.pending.popleft()
+            fut.cancel()
+            self.slots.release()
+        self.buf = bytearray()
+
+
 class Encrypt:
-    def __init__(self, key=None, level=22):
+    frame_size = 4194304 # 4 MB
+
+    def __init__(self, key=None, level=22, target=None):
         if not key:
             raise Exception('need an encryption key')
         if isinstance(key, str):
             key = key.encode('utf-8')
+        self.key = key
         self.f = Fernet(key)
+        self.frame_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                              info=b's3_archive frames').derive(base64.urlsafe_b64decode(key))
         self.level = level
+        self.auto = AutoLevel(level, target) if target else None
+        self.pool = None
+        self.slots = None
+
+    def start_pool(self, processes):
+        """
+        Encode frames in a pool of processes, so compression and
+        encryption are not limited by the GIL.
+
+        Args:
+            processes (int): number of processes
+        """
+        if self.pool or processes < 1:
+            return
+        # spawn, since forking a process with running threads is unsafe
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_pool, initargs=(self.key,))
+        self.slots = threading.BoundedSemaphore(processes*2)
+
+    def stop_pool(self):
+        """Shut down the process pool"""
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+            self.slots = None
 
     @staticmethod
     def get_key():
         return Fernet.generate_key().decode('utf-8')
 
+    def encoder(self, fileobj, level=None):
+        """
+        Get an Encoder writing to `fileobj`.
+
+        Args:
+            fileobj (file): file object to write the encoded object to
+            level (int): (optional) compression level, instead of the default
+        """
+        if level is None:
+            return Encoder(self.frame_key, fileobj, self.level, self.frame_size, self.auto,
+                           self.pool, self.slots)
+        return Encoder(self.frame_key, fileobj, level, self.frame_size,
+                       pool=self.pool, slots=self.slots)
+
     def encode(self, data):
-        d = self.f.encrypt(zstd.compress(data, self.level))
-        return base64.urlsafe_b64decode(d)
+        out = io.BytesIO()
+        e = self.encoder(out)
+        e.write(data)
+        e.close()
+        return out.getvalue()
+
+    def encode_stream(self, fin, fout, level=None):
+        """
+        Encode the contents of one file object into another.
+
+        Args:
+            fin (file): file object to read data from
+            fout (file): file object to write the encoded object to
+            level (int): (optional) compression level, instead of the default
+        """
+        e = self.encoder(fout, level)
+        try:
+            data = fin.read(self.frame_size)
+            while data:
+                e.write(data)
+                data = fin.read(self.frame_size)
+            e.close()
+        except BaseException:
+            e.abort()
+            raise
 
     def decode(self, data):
-        d = base64.urlsafe_b64encode(data)
-        return zstd.decompress(self.f.decrypt(d))
+        out = io.BytesIO()
+        self.decode_stream(io.BytesIO(data), out)
+        return out.getvalue()
+
+    def decode_stream(self, fin, fout, start=0, end=None):
+        """
+        Decode an object from one file object into another.
+
+        Objects in the frame format are decoded one frame at a time, and
+        reading stops at the frame holding `end`.
+        Objects in the original Fernet format are decoded in memory.
+
+        Args:
+            fin (file): file object to read the encoded object from
+            fout (file): file object to write the decoded data to
+            start (int): (optional) the first byte of decoded data to write
+            end (int): (optional) where to stop writing decoded data
+        """
+        header = fin.read(len(MAGIC)+1)
+        if header[:len(MAGIC)] != MAGIC:
+            d = base64.urlsafe_b64encode(header + fin.read())
+            fout.write(zstd.decompress(self.f.decrypt(d))[start:end])
+            return
+        if header[-1] != VERSION:
+            raise Exception('unknown object version %d' % header[-1])
+        header += read_exact(fin, SALT_SIZE)
+        aead = object_cipher(self.frame_key, header[-SALT_SIZE:])
+        counter = 0
+        pos = 0
+        while True:
+            flags, length = FRAME_HEADER.unpack(read_exact(fin, FRAME_HEADER.size))
+            nonce = NONCE_PREFIX + struct.pack('>I', counter)
+            aad = header + struct.pack('>BI', flags, counter)
+            d = aead.decrypt(nonce, read_exact(fin, length), aad)
+            if not flags & FRAME_RAW:
+                d = zstd.decompress(d)
+            if start <= pos and (end is None or pos+len(d) <= end):
+                fout.write(d)
+            elif pos+len(d) > start and (end is None or pos < end):
+                fout.write(memoryview(d)[max(start-pos, 0):None if end is None else end-pos])
+            pos += len(d)
+            if flags & FRAME_LAST or (end is not None and pos >= end):
+                break
+            counter += 1
 
 
 class Settings(dict):
@@ -86,10 +623,68 @@ def sha512sum(filename):
             data = f.read(65536)
     return m.hexdigest()
 
+def read_chunks(f, chunker, checksum=None, block_size=4194304):
+    """
+    Read a file once, splitting it into chunks.
+
+    Each block read is fed to the chunk checksum and the whole-file
+    checksum, and spooled, so a chunk can be looked up by its checksum
+    before it is encoded.  Chunks are spooled to disk when large.
+
+    Args:
+        f (file): a file opened in binary mode
+        chunker (chunker object): decides where chunks end
+        checksum (hashlib object): (optional) a whole-file hash to update
+        block_size (int): (optional) the bytes to read at a time
+
+    Yields:
+        tuple: (chunk checksum, chunk size, chunk file object)
+
+    The caller is responsible for closing each chunk file object.
+    """
+    first = True
+    data = f.read(block_size)
+    while True:
+        m = hashlib.sha512()
+        size = 0
+        out = spool()
+        try:
+            while data:
+                start = time.monotonic()
+                n = chunker.boundary(data)
+                block = data if n is None else data[:n]
+                hashed = time.monotonic()
+                m.update(block)
+                if checksum:
+                    checksum.update(block)
+                metrics.observe('chunk', hashed-start, len(block))
+                metrics.observe('hash', time.monotonic()-hashed, len(block))
+                out.write(block)
+                size += len(block)
+                if n is None:
+                    data = f.read(block_size)
+                else:
+                    data = data[n:] or f.read(block_size)
+                    break
+        except BaseException:
+            out.close()
+            raise
+        if size or first:
+            out.seek(0)
+            yield m.hexdigest(), size, out
+        else:
+            out.close()
+        if not data:
+            break
+        first = False
+
+def format_date(timestamp):
+    return datetime.utcfromtimestamp(timestamp).isoformat(timespec='microseconds')
+
 def get_date_modified(filename):
-    return datetime.utcfromtimestamp(os.path.getmtime(filename)).isoformat(timespec='microseconds')
+    return format_date(os.path.getmtime(filename))
 
 def set_date_modified(filename, time):
-    time = datetime.strptime(time, "%Y-%m-%dT%H:%M:%S.%f").timestamp()
+    time = datetime.strptime(time, "%Y-%m-%dT%H:%M:%S.%f").replace(tzinfo=timezone.utc).timestamp()
     os.utime(filename, (time,time), follow_symlinks=False)
 